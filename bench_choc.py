@@ -0,0 +1,332 @@
+'''Benchmarks for proj3_choc.
+
+Run from the directory that holds choc.sqlite:
+
+    python bench_choc.py pool [--repeat N]
+    python bench_choc.py importtime [--budget MS]
+    python bench_choc.py suite [--db PATH] [--repeat N] [--limit N] [--output FILE]
+    python bench_choc.py columnar [--db PATH] [--repeat N] [--limit N]
+    python bench_choc.py memory COMMAND [--db PATH] [--storage MODE] [--backend NAME]
+    python bench_choc.py compare OLD.json NEW.json [--threshold RATIO] [--min-delta-ms MS]
+
+synth_choc.py writes databases of any size to run the suite against.
+'''
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+import proj3_choc
+
+POOL_COMMANDS = [
+    'bars',
+    'bars cocoa bottom 20',
+    'companies ratings top 10',
+    'countries source number_of_bars',
+    'regions source cocoa',
+]
+
+def connect_per_query(query, parameters=()):
+    ''' The connection handling fetch_db used before the pool: open,
+    run one query and close again.
+    '''
+    connection = sqlite3.connect(proj3_choc.DBNAME)
+    result = connection.execute(query, parameters).fetchall()
+    connection.close()
+    return result
+
+def time_commands(commands, repeat):
+    ''' Runs every command `repeat` times through process_command and
+    returns the mean latency per query in microseconds.
+    '''
+    for command in commands:
+        proj3_choc.process_command(command)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for command in commands:
+            proj3_choc.process_command(command)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeat * len(commands)) * 1e6
+
+def bench_pool(repeat=200):
+    ''' Compares per-query latency of connect-per-query against the
+    pooled connections. The result cache is turned off so every command
+    reaches fetch_db.
+    '''
+    proj3_choc.configure_result_cache(0)
+    pooled_fetch = proj3_choc.fetch_db
+    try:
+        proj3_choc.fetch_db = connect_per_query
+        before = time_commands(POOL_COMMANDS, repeat)
+    finally:
+        proj3_choc.fetch_db = pooled_fetch
+    after = time_commands(POOL_COMMANDS, repeat)
+    proj3_choc.close_pool()
+    print(f'connect per query: {before:10.1f} us/query')
+    print(f'pooled:            {after:10.1f} us/query')
+    print(f'speedup:           {before / after:10.2f}x')
+
+IMPORT_BUDGET_MS = 100
+
+def bench_importtime(budget_ms=IMPORT_BUDGET_MS, runs=5):
+    ''' Measures the cost of `import proj3_choc` with python -X importtime in
+    fresh interpreters, prints the slowest imports of the best run and
+    returns 1 if the cumulative time is over budget.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import proj3_choc'],
+                                cwd=here, capture_output=True, text=True, check=True).stderr
+        modules = []
+        for line in stderr.splitlines():
+            if line.startswith('import time:') and '|' in line and 'self [us]' not in line:
+                own, cumulative, name = line[len('import time:'):].split('|')
+                modules.append((int(cumulative), int(own), name.strip()))
+        total = next(cumulative for cumulative, _, name in modules if name == 'proj3_choc')
+        if best is None or total < best[0]:
+            best = (total, modules)
+    total, modules = best
+    print(f'import proj3_choc: {total / 1000:.1f} ms (budget {budget_ms} ms)')
+    for cumulative, own, name in sorted(modules, key=lambda module: -module[1])[:10]:
+        print(f'{own / 1000:8.1f} ms self {cumulative / 1000:8.1f} ms cumulative  {name}')
+    return 1 if total / 1000 > budget_ms else 0
+
+def suite_commands(dbname, limit=10):
+    ''' Returns one command for every combination of family, metric,
+    sell/source, area filter and top/bottom. Area filters use the most
+    common company location of the database.
+    '''
+    connection = sqlite3.connect(dbname)
+    try:
+        alpha2, region = connection.execute('select c.Alpha2,c.Region from Bars b join Countries c \
+on b.CompanyLocationId=c.Id group by c.Id order by count(*) desc limit 1').fetchone()
+    finally:
+        connection.close()
+    areas = {'none': '', 'country': f' country={alpha2}', 'region': f' region={region}'}
+    commands = []
+    for family, options in proj3_choc.COMMAND_OPTIONS.items():
+        if family == 'search':
+            continue
+        metrics = [metric for metric in proj3_choc.METRICS if metric in options]
+        sources = [f' {source}' for source in ('sell', 'source') if source in options] or ['']
+        for metric in metrics:
+            for source in sources:
+                for area in ('none',) + proj3_choc.AREA_KINDS[family]:
+                    for order in proj3_choc.ORDERS:
+                        commands.append(f'{family} {metric}{source} {order} {limit}{areas[area]}')
+    return commands
+
+def peak_rss_kb():
+    ''' Peak resident set size of the whole process so far; it never goes down.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def measure_memory(command):
+    ''' Formats one command in this process and prints the peak RSS before and
+    after it, in kB. Meant to run in a fresh interpreter per command so the
+    peak covers SQLite's page cache and sorter as well as Python objects.
+    '''
+    proj3_choc.configure_result_cache(0)
+    plan = proj3_choc.parse_command(command)
+    before = peak_rss_kb()
+    with open(os.devnull, 'w') as out:
+        proj3_choc.write_query_result(plan, out)
+    print(before, peak_rss_kb())
+    return 0
+
+def command_rss_kb(command, dbname):
+    ''' Runs measure_memory for one command in a fresh interpreter on the same
+    database, storage and backend, and returns its (baseline, peak) RSS in kB.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    stdout = subprocess.run([sys.executable, os.path.join(here, 'bench_choc.py'), 'memory', command,
+                             '--db', os.path.abspath(dbname), '--storage', proj3_choc.STORAGE,
+                             '--backend', proj3_choc.BACKEND],
+                            cwd=here, capture_output=True, text=True, check=True).stdout
+    before, peak = stdout.split()
+    return int(before), int(peak)
+
+def git_version():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(dbname=None, repeat=20, limit=10, output=None):
+    ''' Times every suite command through the full formatting path with the
+    result cache turned off, and writes p50/p95 latency and rows/sec per
+    command as JSON. Peak RSS is measured with every command in its own
+    process, next to that process's RSS before the command ran.
+    '''
+    if dbname:
+        proj3_choc.DBNAME = dbname
+    proj3_choc.close_pool()
+    proj3_choc.configure_result_cache(0)
+    dbname = proj3_choc.DBNAME
+    results = {}
+    for command in suite_commands(dbname, limit):
+        plan = proj3_choc.parse_command(command)
+        rows = len(proj3_choc.process_command(plan))
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            proj3_choc.write_query_result(plan, io.StringIO())
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        mean = statistics.fmean(samples)
+        base_rss_kb, peak_rss = command_rss_kb(command, dbname)
+        results[command] = {
+            'p50_ms': statistics.median(samples) * 1000,
+            'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+            'rows': rows,
+            'rows_per_sec': rows / mean if mean else None,
+            'base_rss_kb': base_rss_kb,
+            'peak_rss_kb': peak_rss,
+        }
+        print(f"{command:55} p50 {results[command]['p50_ms']:9.2f} ms  p95 {results[command]['p95_ms']:9.2f} ms",
+              file=sys.stderr)
+    connection = sqlite3.connect(dbname)
+    try:
+        bars = connection.execute('select count(*) from Bars').fetchone()[0]
+    finally:
+        connection.close()
+    report = {
+        'meta': {
+            'version': git_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'database': os.path.abspath(dbname),
+            'bars': bars,
+            'storage': proj3_choc.STORAGE,
+            'backend': proj3_choc.BACKEND,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+def bench_columnar(dbname=None, repeat=5, limit=10):
+    ''' Runs every suite command on the SQLite and columnar backends, checks
+    that both return the same rows and prints the speedup. Returns 1 if any
+    result differs.
+    '''
+    if dbname:
+        proj3_choc.DBNAME = dbname
+    proj3_choc.close_pool()
+    proj3_choc.configure_result_cache(0)
+    start = time.perf_counter()
+    proj3_choc.columnar_store()
+    print(f'columnar load: {(time.perf_counter() - start) * 1000:.1f} ms', file=sys.stderr)
+    totals = {backend: 0.0 for backend in proj3_choc.BACKENDS}
+    mismatches = 0
+    for command in suite_commands(proj3_choc.DBNAME, limit):
+        plan = proj3_choc.parse_command(command)
+        rows, best = {}, {}
+        for backend in proj3_choc.BACKENDS:
+            proj3_choc.set_backend(backend)
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                rows[backend] = proj3_choc.fetch_plan(plan)
+                samples.append(time.perf_counter() - start)
+            best[backend] = min(samples)
+            totals[backend] += best[backend]
+        flag = ''
+        if rows['sqlite'] != rows['columnar']:
+            flag = '  MISMATCH'
+            mismatches += 1
+        print(f"{command:55} sqlite {best['sqlite'] * 1000:9.2f} ms  columnar {best['columnar'] * 1000:9.2f} ms"
+              f"  {best['sqlite'] / best['columnar']:7.1f}x{flag}")
+    proj3_choc.set_backend('sqlite')
+    print(f"total: sqlite {totals['sqlite'] * 1000:.1f} ms, columnar {totals['columnar'] * 1000:.1f} ms, "
+          f"speedup {totals['sqlite'] / totals['columnar']:.1f}x, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+def compare_reports(old, new, threshold=1.2, min_delta_ms=1.0):
+    ''' Prints the p50 ratio of every command in two suite reports and
+    returns 1 if any command got slower by more than threshold. Changes
+    smaller than min_delta_ms are treated as noise.
+    '''
+    with open(old) as f:
+        before = json.load(f)
+    with open(new) as f:
+        after = json.load(f)
+    print(f"{before['meta']['version']} ({before['meta']['bars']} bars) -> "
+          f"{after['meta']['version']} ({after['meta']['bars']} bars)")
+    regressions = 0
+    for command, result in after['results'].items():
+        if command not in before['results']:
+            continue
+        previous = before['results'][command]['p50_ms']
+        ratio = result['p50_ms'] / previous
+        flag = ''
+        if ratio > threshold and result['p50_ms'] - previous > min_delta_ms:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'{command:55} {ratio:6.2f}x{flag}')
+    print(f'{regressions} regressions')
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for proj3_choc.')
+    commands = parser.add_subparsers(dest='benchmark', required=True)
+    pool = commands.add_parser('pool', help='connect-per-query against pooled connections')
+    pool.add_argument('--repeat', type=int, default=200)
+    importtime = commands.add_parser('importtime', help='import time of proj3_choc')
+    importtime.add_argument('--budget', type=int, default=IMPORT_BUDGET_MS)
+    suite = commands.add_parser('suite', help='latency of every command combination')
+    suite.add_argument('--db')
+    suite.add_argument('--repeat', type=int, default=20)
+    suite.add_argument('--limit', type=int, default=10)
+    suite.add_argument('--output')
+    columnar = commands.add_parser('columnar', help='SQLite against the NumPy columnar backend')
+    columnar.add_argument('--db')
+    columnar.add_argument('--repeat', type=int, default=5)
+    columnar.add_argument('--limit', type=int, default=10)
+    memory = commands.add_parser('memory', help='peak RSS of one command in this process')
+    memory.add_argument('command')
+    memory.add_argument('--db')
+    memory.add_argument('--storage', choices=proj3_choc.STORAGE_MODES, default=proj3_choc.STORAGE)
+    memory.add_argument('--backend', choices=proj3_choc.BACKENDS, default=proj3_choc.BACKEND)
+    compare = commands.add_parser('compare', help='compare two suite reports')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=1.2)
+    compare.add_argument('--min-delta-ms', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'pool':
+        return bench_pool(args.repeat)
+    if args.benchmark == 'importtime':
+        return bench_importtime(args.budget)
+    if args.benchmark == 'suite':
+        return bench_suite(args.db, args.repeat, args.limit, args.output)
+    if args.benchmark == 'columnar':
+        return bench_columnar(args.db, args.repeat, args.limit)
+    if args.benchmark == 'memory':
+        if args.db:
+            proj3_choc.DBNAME = args.db
+        proj3_choc.set_storage(args.storage)
+        proj3_choc.set_backend(args.backend)
+        return measure_memory(args.command)
+    return compare_reports(args.old, args.new, args.threshold, args.min_delta_ms)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,133 +1,2224 @@
 import sqlite3
-import pandas as pd
 import re
-import plotly.graph_objs as go
+import argparse
+import atexit
+import collections
+import concurrent.futures
+import csv
+import functools
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import pathlib
+import pickle
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
 
 # Part 1: Read data from a database called choc.db
 DBNAME = 'choc.sqlite'
 
+# Pragmas applied to every pooled connection. cache_size is in KiB when negative.
+POOL_SIZE = 4
+POOL_PRAGMAS = {
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'query_only': 1,
+}
+
+# Storage modes. 'disk' reads the file through ordinary connections,
+# 'memory' copies it into an in-process database at startup with the backup
+# API, and 'immutable' opens it with immutable=1, which skips file locking
+# and change detection, and maps it whole into memory. The last two treat
+# the database as a read-only snapshot: changes to the file are not seen.
+STORAGE_MODES = ('disk', 'memory', 'immutable')
+STORAGE = os.environ.get('CHOC_STORAGE', 'disk')
+IMMUTABLE_MMAP_SIZE = 2147418112
+
+def set_storage(mode):
+    ''' Chooses how pooled connections open DBNAME: 'disk', 'memory' or 'immutable'.
+    Takes effect for pools created afterwards.
+    '''
+    global STORAGE
+    if mode not in STORAGE_MODES:
+        raise ValueError(f'unknown storage mode {mode!r}, expected one of {STORAGE_MODES}')
+    STORAGE = mode
+
+class ConnectionPool:
+    '''A bounded pool of read-only connections to a SQLite database.
+
+    Connections are opened lazily, up to `size` of them, and handed back
+    to the pool instead of being closed. A thread that already holds a
+    connection gets the same one back on nested acquires.
+
+    Instance Attributes
+    -------------------
+    dbname: string
+        path of the database file
+    size: int
+        maximum number of open connections
+    storage: string
+        one of STORAGE_MODES
+    '''
+    def __init__(self, dbname=DBNAME, size=POOL_SIZE, pragmas=None, storage=None):
+        self.dbname = dbname
+        self.size = size
+        self.storage = storage or STORAGE
+        if self.storage not in STORAGE_MODES:
+            raise ValueError(f'unknown storage mode {self.storage!r}, expected one of {STORAGE_MODES}')
+        self.pragmas = dict(POOL_PRAGMAS if pragmas is None else pragmas)
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+        self._memory = None
+        path = pathlib.Path(self.dbname).resolve()
+        if self.storage == 'memory':
+            # The memdb VFS shares one in-memory database between all connections
+            # naming it, for as long as one of them stays open; _memory is that one.
+            self._uri = f'file:/choc-{os.getpid()}-{id(self)}?vfs=memdb'
+            self._memory = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+            source = sqlite3.connect(path.as_uri() + '?mode=ro', uri=True)
+            try:
+                source.backup(self._memory)
+            finally:
+                source.close()
+            self.pragmas.pop('mmap_size', None)
+        elif self.storage == 'immutable':
+            self._uri = path.as_uri() + '?mode=ro&immutable=1'
+            self.pragmas['mmap_size'] = IMMUTABLE_MMAP_SIZE
+        else:
+            self._uri = path.as_uri() + '?mode=ro'
+
+    def _connect(self):
+        connection = sqlite3.connect(self._uri, uri=True, check_same_thread=False,
+                                     cached_statements=STATEMENT_CACHE_SIZE)
+        for name, value in self.pragmas.items():
+            connection.execute(f'pragma {name}={value}')
+        if instrumentation.enabled:
+            connection.set_trace_callback(instrumentation.trace)
+        return connection
+
+    def acquire(self):
+        '''Returns a connection for the calling thread, blocking while
+        all `size` connections are in use by other threads.
+        '''
+        held = getattr(self._local, 'connection', None)
+        if held is not None:
+            self._local.depth += 1
+            return held
+        if self._closed:
+            raise RuntimeError('connection pool is closed')
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = len(self._all) < self.size
+                if create:
+                    connection = self._connect()
+                    self._all.append(connection)
+            if not create:
+                connection = self._idle.get()
+        self._local.connection = connection
+        self._local.depth = 1
+        return connection
+
+    def release(self, connection):
+        '''Gives a connection obtained from `acquire` back to the pool.'''
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        self._local.connection = None
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        '''Closes every connection the pool has opened.'''
+        with self._lock:
+            self._closed = True
+            connections, self._all = self._all, []
+            memory, self._memory = self._memory, None
+        for connection in connections:
+            connection.close()
+        if memory is not None:
+            memory.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def configure_pool(size=POOL_SIZE):
+    ''' Replaces the process wide connection pool with one holding up to
+    size connections, unless the current pool is already that large.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.size >= size:
+            return _pool
+        old, _pool = _pool, ConnectionPool(DBNAME, size)
+    if old is not None:
+        old.close()
+    return _pool
+
+def get_pool():
+    '''Returns the process wide connection pool, creating it on first use.'''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DBNAME)
+    return _pool
+
+def _cache_watcher():
+    # Snapshot storage never sees changes, so there is nothing to watch.
+    if STORAGE != 'disk':
+        return None
+    return ShardWatcher(SHARDS) if SHARDS else DatabaseWatcher(DBNAME)
+
+def close_pool():
+    '''Closes the process wide connection pool and shard connections, if opened, and the
+    result cache's watcher connection. Cached results are kept.'''
+    global _pool, _shard_set
+    with _pool_lock:
+        pool, _pool = _pool, None
+        shards, _shard_set = _shard_set, None
+        cache = _result_cache
+    if pool is not None:
+        pool.close()
+    if shards is not None:
+        shards.close()
+    if cache is not None and cache.watcher is not None:
+        cache.watcher.close()
+
+atexit.register(close_pool)
+
+# Result cache settings. ttl is in seconds and max_bytes is an estimate of
+# the memory held by cached rows; None disables either limit.
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = None
+RESULT_CACHE_MAX_BYTES = None
+
+def _result_size(rows):
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+class DatabaseWatcher:
+    '''Detects changes to a database file.
+
+    The stamp combines the file's inode, mtime and size (and those of its
+    WAL file) with `PRAGMA data_version` read on a dedicated connection,
+    which changes whenever another connection commits.
+
+    Instance Attributes
+    -------------------
+    dbname: string
+        path of the database file
+    '''
+    def __init__(self, dbname=DBNAME):
+        self.dbname = dbname
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _file_stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def stamp(self):
+        ''' Returns a value that changes whenever the database does.'''
+        files = (self._file_stamp(self.dbname), self._file_stamp(self.dbname + '-wal'))
+        with self._lock:
+            if self._connection is None or files[0] != self._opened:
+                self.close()
+                uri = pathlib.Path(self.dbname).resolve().as_uri() + '?mode=ro'
+                self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                self._opened = files[0]
+            version = self._connection.execute('pragma data_version').fetchone()[0]
+        return files + (version,)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+class ResultCache:
+    '''An LRU cache of query results that is emptied when the database changes.
+
+    Instance Attributes
+    -------------------
+    maxsize: int
+        maximum number of cached results
+    ttl: float
+        seconds a result stays valid, or None
+    max_bytes: int
+        estimated memory budget for all cached rows, or None
+    hits: int
+        number of lookups answered from the cache
+    misses: int
+        number of lookups that had to query the database
+    evictions: int
+        number of results dropped for size, memory or age
+    invalidations: int
+        number of times the cache was cleared because the database changed
+    '''
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 max_bytes=RESULT_CACHE_MAX_BYTES, watcher=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.watcher = watcher
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _check_stamp(self):
+        if self.watcher is None:
+            return
+        stamp = self.watcher.stamp()
+        if stamp != self._stamp:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._stamp = stamp
+
+    def _pop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        ''' Returns the cached rows for key, or None on a miss.'''
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        ''' Like get, but returns (rows, stamp). Pass the stamp on to put, so
+        that rows read before the database changed are not stored after it.
+        '''
+        with self._lock:
+            self._check_stamp()
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._pop(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None, self._stamp
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[0]), self._stamp
+
+    def put(self, key, rows, stamp=None):
+        ''' Stores rows under key, evicting least recently used results as
+        needed. Given the stamp from lookup, rows are dropped if the database
+        has changed since.
+        '''
+        size = _result_size(rows) if self.max_bytes is not None else 0
+        if self.maxsize <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        with self._lock:
+            if stamp is not None:
+                self._check_stamp()
+                if stamp != self._stamp:
+                    return
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (list(rows), size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        ''' Returns the cache counters as a dict.'''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+_result_cache = None
+
+def get_result_cache():
+    ''' Returns the process wide result cache, creating it on first use.'''
+    global _result_cache
+    if _result_cache is None:
+        with _pool_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(watcher=_cache_watcher())
+    return _result_cache
+
+def configure_result_cache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_MAX_BYTES):
+    ''' Replaces the process wide result cache with one using the given limits.
+    A maxsize of 0 turns caching off.
+    '''
+    global _result_cache
+    with _pool_lock:
+        old, _result_cache = _result_cache, ResultCache(maxsize, ttl, max_bytes, _cache_watcher())
+    if old is not None and old.watcher is not None:
+        old.watcher.close()
+    return _result_cache
+
+def cache_stats():
+    ''' Returns hit/miss counters of the process wide result cache.'''
+    return get_result_cache().stats()
+
+# Instrumentation. Off unless CHOC_INSTRUMENT=1 or enable_instrumentation() is
+# called. Stage times are exclusive: time spent running SQL is recorded as
+# the 'query' stage and not counted again in the stage around it.
+HISTOGRAM_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+ROLLING_SAMPLES = 1024
+TRACE_SIZE = 100
+
+class Histogram:
+    '''Durations of one stage or statement: cumulative bucket counts plus a
+    rolling window of recent samples for percentiles.
+
+    Instance Attributes
+    -------------------
+    count: int
+        number of observations
+    total: float
+        sum of all observed durations in seconds
+    rows: int
+        rows returned across all observations
+    '''
+    def __init__(self, samples=ROLLING_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.buckets = [0] * len(HISTOGRAM_BUCKETS)
+        self.recent = collections.deque(maxlen=samples)
+
+    def observe(self, seconds, rows=0):
+        self.count += 1
+        self.total += seconds
+        self.rows += rows
+        self.recent.append(seconds)
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+
+    def summary(self):
+        recent = sorted(self.recent)
+        def percentile(fraction):
+            return recent[min(len(recent) - 1, int(len(recent) * fraction))] * 1000 if recent else None
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'mean_ms': self.total / self.count * 1000 if self.count else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'max_ms': recent[-1] * 1000 if recent else None,
+            'rows': self.rows,
+            'buckets': dict(zip(HISTOGRAM_BUCKETS, self.buckets)),
+        }
+
+class Instrumentation:
+    '''Per-stage timings, per-statement timings and a trace of executed SQL.
+
+    Instance Attributes
+    -------------------
+    enabled: bool
+        whether anything is recorded
+    stages: dict
+        stage name -> Histogram
+    statements: dict
+        SQL template -> Histogram
+    traced: deque
+        the most recent SQL statements reported by sqlite3's trace callback
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self.statements = {}
+        self.traced = collections.deque(maxlen=TRACE_SIZE)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _nested(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _observe(self, histograms, name, seconds, rows=0):
+        with self._lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.observe(seconds, rows)
+
+    @contextmanager
+    def stage(self, name):
+        ''' Times the body of a with block as stage name.'''
+        if not self.enabled:
+            yield
+            return
+        stack = self._nested()
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self._observe(self.stages, name, elapsed - nested)
+
+    def record_statement(self, sql, seconds, rows):
+        ''' Records one executed statement, its duration and the rows it returned.'''
+        if not self.enabled:
+            return
+        stack = self._nested()
+        if stack:
+            stack[-1] += seconds
+        self._observe(self.statements, sql, seconds, rows)
+        self._observe(self.stages, 'query', seconds, rows)
+
+    def trace(self, statement):
+        ''' sqlite3 trace callback.'''
+        self.traced.append(statement)
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.statements.clear()
+            self.traced.clear()
+
+    def snapshot(self):
+        ''' Returns everything recorded so far as a JSON serializable dict.'''
+        with self._lock:
+            stages = {name: histogram.summary() for name, histogram in self.stages.items()}
+            statements = {sql: histogram.summary() for sql, histogram in self.statements.items()}
+            traced = list(self.traced)
+        return {
+            'enabled': self.enabled,
+            'stages': stages,
+            'statements': statements,
+            'cache': cache_stats(),
+            'traced': traced,
+        }
+
+instrumentation = Instrumentation(os.environ.get('CHOC_INSTRUMENT') == '1')
+
+def enable_instrumentation(enabled=True):
+    ''' Turns instrumentation on or off, including the SQL trace callback on
+    connections the pool has already opened.
+    '''
+    instrumentation.enabled = enabled
+    pool = _pool
+    if pool is not None:
+        for connection in list(pool._all):
+            connection.set_trace_callback(instrumentation.trace if enabled else None)
+
+def format_stats():
+    ''' Returns the recorded stage and statement timings as text for the prompt.'''
+    if not instrumentation.enabled:
+        return 'Instrumentation is off. Start with --instrument or set CHOC_INSTRUMENT=1.'
+    snapshot = instrumentation.snapshot()
+    lines = [f"{'stage':12} {'count':>8} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'rows':>10}"]
+    for name, summary in sorted(snapshot['stages'].items()):
+        lines.append(f"{name:12} {summary['count']:8} {summary['mean_ms']:10.3f} "
+                     f"{summary['p50_ms']:10.3f} {summary['p95_ms']:10.3f} {summary['rows']:10}")
+    slowest = sorted(snapshot['statements'].items(), key=lambda item: -item[1]['total_ms'])[:5]
+    if slowest:
+        lines.append('')
+        lines.append('slowest statements (total ms, count):')
+        for sql, summary in slowest:
+            lines.append(f"{summary['total_ms']:10.3f} {summary['count']:6}  {' '.join(sql.split())[:100]}")
+    cache = snapshot['cache']
+    lines.append('')
+    lines.append(f"result cache: {cache['hits']} hits, {cache['misses']} misses, {cache['entries']} entries")
+    if _plot_renderer is not None:
+        plots = _plot_renderer.stats()
+        lines.append(f"plots: {plots['renders']} rendered, {plots['hits']} from cache")
+    return '\n'.join(lines)
+
+def _prometheus_label(value):
+    return ' '.join(value.split()).replace('\\', '\\\\').replace('"', '\\"')
+
+def stats_prometheus():
+    ''' Returns the recorded timings in the Prometheus text exposition format.'''
+    snapshot = instrumentation.snapshot()
+    lines = []
+    for metric, label, summaries in (('choc_stage_seconds', 'stage', snapshot['stages']),
+                                     ('choc_statement_seconds', 'sql', snapshot['statements'])):
+        lines.append(f'# TYPE {metric} histogram')
+        for name, summary in summaries.items():
+            labels = f'{label}="{_prometheus_label(name)}"'
+            for bound, count in summary['buckets'].items():
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {summary["count"]}')
+            lines.append(f'{metric}_sum{{{labels}}} {summary["total_ms"] / 1000}')
+            lines.append(f'{metric}_count{{{labels}}} {summary["count"]}')
+    lines.append('# TYPE choc_rows_total counter')
+    for name, summary in snapshot['statements'].items():
+        lines.append(f'choc_rows_total{{sql="{_prometheus_label(name)}"}} {summary["rows"]}')
+    for name in ('hits', 'misses', 'evictions', 'invalidations'):
+        lines.append(f'# TYPE choc_cache_{name}_total counter')
+        lines.append(f'choc_cache_{name}_total {snapshot["cache"][name]}')
+    return '\n'.join(lines) + '\n'
+
+def dump_stats(path, fmt=None):
+    ''' Writes the recorded timings to a file
+
+    Parameters
+    ----------
+    path: string
+        file to write
+    fmt: string
+        'json' or 'prometheus'; by default files ending in .prom or .txt get
+        the Prometheus text format and anything else JSON
+
+    Returns
+    -------
+    None
+    '''
+    if fmt is None:
+        fmt = 'prometheus' if path.endswith(('.prom', '.txt')) else 'json'
+    text = stats_prometheus() if fmt == 'prometheus' else json.dumps(instrumentation.snapshot(), indent=2) + '\n'
+    with open(path, 'w') as f:
+        f.write(text)
+
 # Part 1: Implement logic to process user commands
-def fetch_db(query):
-    connection = sqlite3.connect(DBNAME)
-    cursor = connection.cursor()
-    result = cursor.execute(query).fetchall()
-    connection.close()
-    return result
-
-def bar_plot(xvalue,yvalue):
-    graph=go.Bar(x=xvalue,y=yvalue)
-    fig=go.Figure(data=graph)
-    return fig.show()
-
-def process_command(command):
+def fetch_db(query, parameters=()):
+    with get_pool().connection() as connection:
+        start = time.perf_counter()
+        result = connection.execute(query, parameters).fetchall()
+        instrumentation.record_statement(query, time.perf_counter() - start, len(result))
+        return result
+
+def cached_fetch_db(query, parameters=(), key=None):
+    ''' Like fetch_db, but answers repeated queries from the result cache.
+    The cache key defaults to the SQL template and bound parameters.
+    '''
+    cache = get_result_cache()
+    key = (query, parameters) if key is None else key
+    results, stamp = cache.lookup(key)
+    if results is None:
+        results = fetch_db(query, parameters)
+        cache.put(key, results, stamp)
+    return results
+
+FETCH_CHUNK_SIZE = 1000
+STREAM_CACHE_ROWS = 10000
+
+def stream_db(query, parameters=(), chunk_size=FETCH_CHUNK_SIZE, key=None):
+    ''' Yields the rows of a query, fetching them from the cursor in chunks.
+    Results of up to STREAM_CACHE_ROWS rows also go into the result cache;
+    larger ones are never held in memory as a whole.
+    '''
+    cache = get_result_cache()
+    key = (query, parameters) if key is None else key
+    results, stamp = cache.lookup(key)
+    if results is not None:
+        yield from results
+        return
+    collected = []
+    rows = 0
+    with get_pool().connection() as connection:
+        start = time.perf_counter()
+        cursor = connection.execute(query, parameters)
+        elapsed = 0.0
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            elapsed += time.perf_counter() - start
+            if not chunk:
+                break
+            rows += len(chunk)
+            if collected is not None:
+                collected.extend(chunk)
+                if len(collected) > STREAM_CACHE_ROWS:
+                    collected = None
+            yield from chunk
+            start = time.perf_counter()
+    instrumentation.record_statement(query, elapsed, rows)
+    if collected is not None:
+        cache.put(key, collected, stamp)
+
+# Plot rendering. Figures are built on a background thread so the prompt
+# does not wait for plotly, and rendered pages are cached by plan. Pages
+# load plotly.js from a plotly.min.js written once next to them instead of
+# embedding its several megabytes in every file.
+PLOT_MAX_BARS = 2000
+PLOT_CACHE_SIZE = 64
+PLOT_FORMATS = ('html', 'json')
+PLOT_EXPORT_DIR = None
+PLOT_EXPORT_FORMAT = 'html'
+
+def set_plot_export(directory, fmt='html'):
+    ''' Makes barplot commands write their plot to a file in directory instead
+    of opening a browser. A directory of None opens the browser again.
+    '''
+    global PLOT_EXPORT_DIR, PLOT_EXPORT_FORMAT
+    if fmt not in PLOT_FORMATS:
+        raise ValueError(f'unknown plot format {fmt!r}, expected one of {PLOT_FORMATS}')
+    PLOT_EXPORT_DIR = directory
+    PLOT_EXPORT_FORMAT = fmt
+
+def downsample_bars(xvalue, yvalue, max_bars=PLOT_MAX_BARS):
+    ''' Averages runs of neighbouring bars so that at most max_bars remain.
+    Results come sorted by the plotted value, so the shape of the plot is kept.
+
+    Parameters
+    ----------
+    xvalue: list
+        bar labels
+    yvalue: list
+        bar heights, None for a missing value
+    max_bars: int
+        largest number of bars to draw
+
+    Returns
+    -------
+    tuple
+        labels, heights and the number of bars averaged into each one
+    '''
+    if len(xvalue) <= max_bars:
+        return list(xvalue), list(yvalue), 1
+    size = math.ceil(len(xvalue) / max_bars)
+    x, y = [], []
+    for start in range(0, len(xvalue), size):
+        labels = xvalue[start:start + size]
+        values = [value for value in yvalue[start:start + size] if value is not None]
+        x.append(f'{labels[0]} .. {labels[-1]}' if len(labels) > 1 else labels[0])
+        y.append(sum(values) / len(values) if values else None)
+    return x, y, size
+
+def build_figure(xvalue, yvalue, max_bars=PLOT_MAX_BARS):
+    ''' Returns a plotly bar chart, downsampled to at most max_bars bars.'''
+    # plotly takes a few hundred milliseconds to import, so only pay for it when plotting
+    import plotly.graph_objs as go
+    x, y, size = downsample_bars(xvalue, yvalue, max_bars)
+    fig = go.Figure(data=go.Bar(x=x, y=y))
+    if size > 1:
+        fig.update_layout(title=f'{len(xvalue)} bars, averaged in groups of {size}')
+    return fig
+
+def plot_filename(plan, fmt='html'):
+    ''' File name for the plot or export of a plan, e.g. companies-ratings-sell-country-us-top-10.html'''
+    parts = [plan.family, plan.metric, plan.source]
+    if plan.terms:
+        parts.insert(1, plan.terms)
+    if plan.area != 'none':
+        parts += [plan.area, plan.area_value]
+    parts += [plan.order, str(plan.limit)]
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', '-'.join(parts)).lower() + '.' + fmt
+
+class PlotRenderer:
+    '''Renders bar plots on background threads and caches them by plan.
+
+    A cached plot is reused while the plotted values are unchanged.
+
+    Instance Attributes
+    -------------------
+    max_bars: int
+        largest number of bars drawn, see downsample_bars
+    cache_size: int
+        number of rendered plots kept
+    renders: int
+        number of plots rendered
+    hits: int
+        number of plots answered from the cache
+    '''
+    def __init__(self, workers=1, cache_size=PLOT_CACHE_SIZE, max_bars=PLOT_MAX_BARS):
+        self.max_bars = max_bars
+        self.cache_size = cache_size
+        self.renders = 0
+        self.hits = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='plot')
+        self._cache = collections.OrderedDict()
+        self._pending = set()
+        self._errors = []
+        self._show_dir = None
+        self._lock = threading.Lock()
+
+    def _render(self, xvalue, yvalue, fmt, plotlyjs):
+        with instrumentation.stage('plot'):
+            fig = build_figure(xvalue, yvalue, self.max_bars)
+            if fmt == 'json':
+                return fig.to_json()
+            return fig.to_html(include_plotlyjs=plotlyjs)
+
+    def render(self, plan, results, fmt='html', plotlyjs='directory'):
+        ''' Starts rendering the plot of a plan's results
+
+        Parameters
+        ----------
+        plan: QueryPlan
+            the command the results belong to
+        results: list
+            rows returned for plan
+        fmt: string
+            'html' for a page, 'json' for the plotly figure JSON
+        plotlyjs: string
+            where the page loads plotly.js from: 'directory' for a
+            plotly.min.js next to it, 'cdn' for the plotly CDN
+
+        Returns
+        -------
+        Future
+            resolves to the rendered text
+        '''
+        if fmt not in PLOT_FORMATS:
+            raise ValueError(f'unknown plot format {fmt!r}, expected one of {PLOT_FORMATS}')
+        x, y = plan.plot_columns
+        values = (tuple(row[x] for row in results), tuple(row[y] for row in results))
+        key = (plan.key, fmt, plotlyjs)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] == values:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self._executor.submit(self._render, *values, fmt, plotlyjs)
+            self.renders += 1
+            self._cache[key] = (values, future)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        # Failed renders are not cached.
+        if future.exception() is not None:
+            with self._lock:
+                if key in self._cache and self._cache[key][1] is future:
+                    del self._cache[key]
+
+    def _after(self, future, action):
+        ''' Runs action on the rendered text and returns a Future for its result.'''
+        outcome = concurrent.futures.Future()
+        with self._lock:
+            self._pending.add(outcome)
+
+        def finish(rendered):
+            try:
+                outcome.set_result(action(rendered.result()))
+            except BaseException as error:
+                with self._lock:
+                    self._errors.append(error)
+                outcome.set_exception(error)
+            with self._lock:
+                self._pending.discard(outcome)
+
+        future.add_done_callback(finish)
+        return outcome
+
+    def _bundle(self, directory):
+        ''' Writes plotly.min.js to directory unless it is already there.'''
+        path = os.path.join(directory, 'plotly.min.js')
+        if not os.path.exists(path):
+            from plotly.offline import get_plotlyjs
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, encoding='utf-8') as f:
+                f.write(get_plotlyjs())
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, path)
+
+    def export(self, plan, results, directory, fmt='html', plotlyjs='directory'):
+        ''' Writes the plot of a plan's results to directory once it is rendered,
+        without waiting for it. Returns a Future for the file's path.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        if fmt == 'html' and plotlyjs == 'directory':
+            self._bundle(directory)
+        path = os.path.join(directory, plot_filename(plan, fmt))
+
+        def write(text):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            return path
+
+        return self._after(self.render(plan, results, fmt, plotlyjs), write)
+
+    def show(self, plan, results):
+        ''' Opens the plot of a plan's results in a web browser once it is
+        rendered, without waiting for it. Returns a Future for the page's path.
+        The page loads plotly.js from the CDN, so nothing large is left in
+        the temporary directory.
+        '''
+        with self._lock:
+            if self._show_dir is None:
+                self._show_dir = tempfile.mkdtemp(prefix='choc-plots-')
+        page = self.export(plan, results, self._show_dir, plotlyjs='cdn')
+
+        def open_page(done):
+            if done.exception() is not None:
+                print(f'Could not draw the plot: {done.exception()}', file=sys.stderr)
+                return
+            import webbrowser
+            webbrowser.open(pathlib.Path(done.result()).as_uri())
+
+        page.add_done_callback(open_page)
+        return page
+
+    def wait(self):
+        ''' Blocks until every started export or show has finished, then raises
+        the first error any of them hit since the last call.
+        '''
+        with self._lock:
+            pending = list(self._pending)
+        concurrent.futures.wait(pending)
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def stats(self):
+        ''' Returns the renderer counters as a dict.'''
+        with self._lock:
+            return {'renders': self.renders, 'hits': self.hits, 'entries': len(self._cache)}
+
+_plot_renderer = None
+
+def get_plot_renderer():
+    ''' Returns the process wide plot renderer, creating it on first use.'''
+    global _plot_renderer
+    if _plot_renderer is None:
+        with _pool_lock:
+            if _plot_renderer is None:
+                _plot_renderer = PlotRenderer()
+    return _plot_renderer
+
+def plot_plan(plan, results):
+    ''' Draws the results of a barplot command in the background: exported to
+    PLOT_EXPORT_DIR when set, otherwise opened in a browser.
+
+    Returns
+    -------
+    Future
+        resolves to the path of the written plot
+    '''
+    renderer = get_plot_renderer()
+    if PLOT_EXPORT_DIR is not None:
+        return renderer.export(plan, results, PLOT_EXPORT_DIR, PLOT_EXPORT_FORMAT)
+    return renderer.show(plan, results)
+
+def process_command(command, fmt=None, out=None):
     '''Take a command string and returns a list of tuples representing records that match the query. 
        If 'barplot' is provided, display a barplot which nicely visualizes the results.
+       The plot is drawn in the background, see plot_plan.
     
     Parameters
     ----------
-    command: string
+    command: string or QueryPlan
         The command string represents a query that the user want to run
+    fmt: string
+        if given, stream the rows to out in this output format instead of
+        returning them, see OUTPUT_FORMATS
+    out: file or string
+        file object or path for the text formats (default sys.stdout),
+        path for npy and arrow
     
     Returns
     -------
     list
-        a list of tuples that represent the query result
-    '''
-    identifier = command.split(' ')[0]
-    if identifier == 'bars':
-        results = Command().bars(command)
-        if 'barplot' in command:
-            xval = [result[0] for result in results]
-            if 'cocoa' in command:
-                yval=[result[4] for result in results]
-                bar_plot(xval,yval)
+        a list of tuples that represent the query result, or the number of
+        rows written when fmt is given
+    '''
+    with instrumentation.stage('parse'):
+        plan = as_plan(command)
+    if fmt in ('npy', 'arrow'):
+        return export_query_result(plan, out, fmt)
+    if fmt is not None and isinstance(out, (str, os.PathLike)):
+        with open(out, 'w', encoding='utf-8', newline='') as f:
+            return write_query_result(plan, f, fmt=fmt)
+    if fmt is not None:
+        return write_query_result(plan, out, fmt=fmt)
+    results = fetch_plan(plan)
+    if plan.barplot:
+        plot_plan(plan, results)
+    return results
+
+def write_query_result(command, out=None, lookahead=None, fmt=None):
+    ''' Streams the formatted result of a command to a file object. Rows are
+    pulled from the cursor in chunks and formatted as they are written, so
+    memory use does not grow with the limit.
+
+    Parameters
+    ----------
+    command: string or QueryPlan
+        The command string represents a query that the user want to run
+    out: file
+        where to write the table, defaults to sys.stdout
+    lookahead: int
+        rows to buffer for column widths before spooling to a temporary file
+    fmt: string
+        'table', 'csv' or 'ndjson', defaults to OUTPUT_FORMAT if it is one of them
+
+    Returns
+    -------
+    int
+        the number of rows written
+    '''
+    with instrumentation.stage('parse'):
+        plan = as_plan(command)
+    with instrumentation.stage('format'):
+        if plan.barplot:
+            rows = process_command(plan)
+        else:
+            rows = stream_plan(plan)
+        return write_rows(plan, rows, out, lookahead, fmt)
+
+# What write_rows reads from a plan, for rows that do not come straight from one.
+RowLayout = collections.namedtuple('RowLayout', 'columns percent_column')
+
+def write_rows(plan, rows, out=None, lookahead=None, fmt=None):
+    ''' Formats rows returned for a plan, see write_query_result, and
+    returns the number of rows written. Only the plan's columns and
+    percent_column are used.
+    '''
+    fmt = fmt or (OUTPUT_FORMAT if OUTPUT_FORMAT in TEXT_FORMATS else 'table')
+    out = out or sys.stdout
+    written = 0
+    def counted(rows):
+        nonlocal written
+        for row in rows:
+            written += 1
+            yield row
+    if fmt == 'csv':
+        write_csv(plan.columns, counted(rows), out)
+    elif fmt == 'ndjson':
+        write_ndjson(plan.columns, counted(rows), out)
+    elif fmt == 'table':
+        percent = plan.percent_column
+        rows = counted(rows)
+        if percent is not None:
+            rows = (format_percent(row, percent) for row in rows)
+        write_table(rows, out, TABLE_LOOKAHEAD if lookahead is None else lookahead)
+    else:
+        raise ValueError(f'{fmt!r} is not a text output format')
+    return written
+
+def print_query_result(command, fmt=None):
+    ''' Pretty prints raw query result 
+    
+    Parameters
+    ----------
+    command: string or QueryPlan
+        The command string represents a query that the user want to run
+    fmt: string
+        'table', 'csv' or 'ndjson', see write_query_result
+    
+    Returns
+    -------
+    string
+        the result formatted as a fixed width table, or as CSV or NDJSON
+    '''
+    out = io.StringIO()
+    write_query_result(command, out, fmt=fmt)
+    return out.getvalue()[:-1]
+
+# Table formatting. This reproduces the layout of pandas'
+# DataFrame.to_string(index=False, header=False, max_colwidth=16) without
+# building a DataFrame: columns are right justified, float columns share one
+# number of decimals and long values are cut to 13 characters plus '...'.
+TABLE_LOOKAHEAD = 10000
+MAX_COLWIDTH = 16
+FLOAT_DIGITS = 6
+EMPTY_TABLE = 'Empty DataFrame\nColumns: []\nIndex: []'
+
+def format_percent(row, index):
+    row = list(row)
+    if row[index] is not None:
+        row[index] = '{:.0%}'.format(row[index])
+    return tuple(row)
+
+class ColumnFormat:
+    '''Collects what is needed to format one column consistently.
+
+    Instance Attributes
+    -------------------
+    kinds: set
+        'int', 'float', 'none' and 'object', for the values seen so far
+    kind: string
+        display type chosen by finish: 'int', 'float' or 'object'
+    width: int
+        column width chosen by finish
+    '''
+    def __init__(self):
+        self.kinds = set()
+        self.text_width = 0
+        self.fixed_width = 0
+        self.scientific_width = 0
+        self.special_width = 0
+        self.trailing_zeros = FLOAT_DIGITS
+        self.small = False
+        self.large = False
+
+    def add(self, value):
+        if value is None:
+            self.kinds.add('none')
+            self.text_width = max(self.text_width, 4)
+            self.special_width = max(self.special_width, 3)
+            return
+        if isinstance(value, int) and not isinstance(value, bool):
+            self.kinds.add('int')
+        elif isinstance(value, float):
+            self.kinds.add('float')
+        else:
+            self.kinds.add('object')
+            self.text_width = max(self.text_width, len(str(value)))
+            return
+        self.text_width = max(self.text_width, len(str(value)))
+        if not math.isfinite(value):
+            self.special_width = max(self.special_width, len(self._special(value)))
+            return
+        fixed = f'{value:.{FLOAT_DIGITS}f}'
+        self.fixed_width = max(self.fixed_width, len(fixed))
+        self.scientific_width = max(self.scientific_width, len(f'{value:.{FLOAT_DIGITS}e}'))
+        self.trailing_zeros = min(self.trailing_zeros, len(fixed) - len(fixed.rstrip('0')))
+        self.small = self.small or 0 < abs(value) < 10 ** -FLOAT_DIGITS
+        self.large = self.large or abs(value) > 1e6
+
+    def _special(self, value):
+        if value is None or math.isnan(value):
+            return 'NaN'
+        return 'inf' if value > 0 else '-inf'
+
+    def finish(self):
+        ''' Fixes the column's display type and width once every value has been added.'''
+        if self.kinds == {'int'}:
+            self.kind = 'int'
+            width = self.text_width
+        elif self.kinds & {'int', 'float'} and self.kinds <= {'int', 'float', 'none'}:
+            self.kind = 'float'
+            self.decimals = max(1, FLOAT_DIGITS - self.trailing_zeros)
+            width = self.fixed_width - (FLOAT_DIGITS - self.decimals) if self.fixed_width else 0
+            self.scientific = self.small or (width > FLOAT_DIGITS + 6 and self.large)
+            if self.scientific:
+                width = self.scientific_width
+            width = max(width, self.special_width)
+        else:
+            self.kind = 'object'
+            width = self.text_width
+        self.width = min(width, MAX_COLWIDTH)
+        return self
+
+    def format(self, value):
+        if self.kind == 'float':
+            if value is None or not math.isfinite(value):
+                text = self._special(value)
+            elif self.scientific:
+                text = f'{value:.{FLOAT_DIGITS}e}'
+            else:
+                text = f'{value:.{self.decimals}f}'
+        else:
+            text = str(value)
+        if len(text) > MAX_COLWIDTH:
+            text = text[:MAX_COLWIDTH - 3] + '...'
+        return text.rjust(self.width)
+
+def _collect(rows, columns):
+    for row in rows:
+        if not columns:
+            columns.extend(ColumnFormat() for _ in row)
+        for column, value in zip(columns, row):
+            column.add(value)
+        yield row
+
+def _spool(rows, chunk_size=FETCH_CHUNK_SIZE):
+    ''' Writes rows to a temporary file in pickled chunks and yields them
+    back once all rows have been written.
+    '''
+    with tempfile.TemporaryFile() as spool:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                pickle.dump(chunk, spool)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, spool)
+        yield None
+        spool.seek(0)
+        while True:
+            try:
+                yield from pickle.load(spool)
+            except EOFError:
+                return
+
+def write_table(rows, out, lookahead=TABLE_LOOKAHEAD):
+    ''' Writes rows as a fixed width table, one line per row. Up to lookahead
+    rows are held in memory; larger results are spooled to a temporary file
+    while the column formats are worked out, then written in a second pass.
+    '''
+    columns = []
+    rows = _collect(rows, columns)
+    head = list(itertools.islice(rows, lookahead + 1))
+    if not head:
+        out.write(EMPTY_TABLE + '\n')
+        return
+    if len(head) > lookahead:
+        rows = _spool(itertools.chain(head, rows))
+        head = None
+        next(rows)
+    else:
+        rows = head
+    for column in columns:
+        column.finish()
+    for row in rows:
+        out.write(' '.join(column.format(value) for column, value in zip(columns, row)) + '\n')
+
+# Machine-readable output. The table above is for people; these formats write
+# the raw values (no truncation, cocoa as a fraction) for other programs, row
+# by row from the cursor. csv and ndjson are text and can go wherever a table
+# goes; npy and arrow are binary and are written to a path: npy as a directory
+# with one NumPy array per column, arrow as an Arrow IPC file (needs pyarrow).
+OUTPUT_FORMATS = ('table', 'csv', 'ndjson', 'npy', 'arrow')
+TEXT_FORMATS = ('table', 'csv', 'ndjson')
+OUTPUT_FORMAT = 'table'
+OUTPUT_DIR = None
+
+# column name -> NumPy dtype of the numeric columns; the rest are text
+NUMERIC_COLUMNS = {
+    'Rating': 'f8',
+    'CocoaPercent': 'f8',
+    'AverageRating': 'f8',
+    'AvgCocoaPercent': 'f8',
+    'NumberOfBars': 'i8',
+}
+
+def set_output(fmt='table', directory=None):
+    ''' Chooses the format of command results at the prompt, in batch mode
+    and from the daemon. Binary formats are only used in batch mode, which
+    writes one file per command into directory.
+    '''
+    global OUTPUT_FORMAT, OUTPUT_DIR
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f'unknown output format {fmt!r}, expected one of {OUTPUT_FORMATS}')
+    OUTPUT_FORMAT = fmt
+    OUTPUT_DIR = directory
+
+def write_csv(columns, rows, out):
+    ''' Writes a header and rows as CSV; None is written as an empty field.'''
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+def write_ndjson(columns, rows, out):
+    ''' Writes one JSON object per row, keyed by column name.'''
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row))) + '\n')
+
+def _chunked(rows, chunk_size):
+    rows = iter(rows)
+    return iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+
+def write_npy(columns, rows, path, chunk_size=FETCH_CHUNK_SIZE):
+    ''' Writes every column to <path>/<column>.npy. Missing numbers become
+    NaN and missing text an empty string, so the files load without pickle.
+    The rows are spooled to a temporary file while they are counted and the
+    text widths measured, then written to the files chunk by chunk.
+    Returns the number of rows.
+    '''
+    import numpy as np
+    count = 0
+    widths = [1] * len(columns)
+    text = [index for index, name in enumerate(columns) if name not in NUMERIC_COLUMNS]
+
+    def measured(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            for index in text:
+                if row[index] is not None and len(row[index]) > widths[index]:
+                    widths[index] = len(row[index])
+            yield row
+
+    spooled = _spool(measured(rows), chunk_size)
+    next(spooled)
+    dtypes = [np.dtype(NUMERIC_COLUMNS.get(name, f'U{width}')) for name, width in zip(columns, widths)]
+    os.makedirs(path, exist_ok=True)
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(os.path.join(path, name + '.npy'), 'wb')) for name in columns]
+        for f, dtype in zip(files, dtypes):
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                     'fortran_order': False, 'shape': (count,)})
+        for chunk in _chunked(spooled, chunk_size):
+            for index, (f, dtype, values) in enumerate(zip(files, dtypes, zip(*chunk))):
+                if index in text:
+                    values = ['' if value is None else value for value in values]
+                f.write(np.array(values, dtype=dtype).tobytes())
+    return count
+
+def write_arrow(columns, rows, path, chunk_size=FETCH_CHUNK_SIZE):
+    ''' Writes rows to an Arrow IPC file, one record batch per chunk.
+    Returns the number of rows.
+    '''
+    try:
+        import pyarrow
+    except ImportError as error:
+        raise RuntimeError("The arrow format needs pyarrow; install it or use 'npy'.") from error
+    types = {'f8': pyarrow.float64(), 'i8': pyarrow.int64()}
+    schema = pyarrow.schema([(name, types[NUMERIC_COLUMNS[name]] if name in NUMERIC_COLUMNS else pyarrow.string())
+                             for name in columns])
+    count = 0
+    with pyarrow.OSFile(path, 'wb') as sink, pyarrow.ipc.new_file(sink, schema) as writer:
+        for chunk in _chunked(rows, chunk_size):
+            count += len(chunk)
+            writer.write_batch(pyarrow.record_batch([pyarrow.array(values, type=field.type)
+                                                     for field, values in zip(schema, zip(*chunk))], schema=schema))
+    return count
+
+def export_query_result(command, path, fmt='npy'):
+    ''' Streams the result of a command to a file in a binary format
+
+    Parameters
+    ----------
+    command: string or QueryPlan
+        The command string represents a query that the user want to run
+    path: string
+        directory for 'npy', file for 'arrow'
+    fmt: string
+        'npy' or 'arrow'
+
+    Returns
+    -------
+    int
+        the number of rows written
+    '''
+    plan = as_plan(command)
+    rows = stream_plan(plan)
+    if fmt == 'npy':
+        return write_npy(plan.columns, rows, path)
+    if fmt == 'arrow':
+        return write_arrow(plan.columns, rows, path)
+    raise ValueError(f'{fmt!r} is not a binary output format')
+
+def export_filename(plan, fmt):
+    ''' Name under OUTPUT_DIR for the export of a plan; npy exports are directories.'''
+    name = plot_filename(plan, fmt)
+    return name[:-len('.npy')] if fmt == 'npy' else name
+
+# SQL templates. Every query Command can run is one of these fixed
+# strings with ? placeholders, so sqlite3's per-connection statement cache
+# reuses the prepared statement no matter which filter values are used.
+STATEMENT_CACHE_SIZE = 256
+
+BARS_SELECT = 'select b.SpecificBeanBarName,b.Company,c.EnglishName,b.Rating,b.CocoaPercent,o.EnglishName \
+from Bars b left join Countries c on b.CompanyLocationId=c.Id left join Countries o on b.BroadBeanOriginId=o.Id'
+
+# Averages are rounded to SORT_DIGITS before they are sorted or shown. Sums
+# added up in another order (summary tables, shards, the columnar backend)
+# can differ in the last bits, and equal averages must still tie and fall
+# back to the group key.
+SORT_DIGITS = 9
+
+# metric -> (bars sort column, aggregate select expression, aggregate sort expression)
+METRICS = {
+    'ratings': ('b.Rating', f'round(round(avg(b.Rating),{SORT_DIGITS}),1) as AverageRating',
+                f'round(avg(b.Rating),{SORT_DIGITS})'),
+    'cocoa': ('b.CocoaPercent', f'round(round(avg(b.CocoaPercent),{SORT_DIGITS}),2) as AvgCocoaPercent',
+              f'round(avg(b.CocoaPercent),{SORT_DIGITS})'),
+    'number_of_bars': (None, 'count(b.Id) as NumberOfBars', 'NumberOfBars'),
+}
+
+# family -> (selected columns, group by key). A company with bars in several
+# locations is shown with the first location by name.
+GROUPS = {
+    'companies': ('b.Company,min(c.EnglishName)', 'b.Company'),
+    'countries': ('c.EnglishName,c.Region', 'c.Id'),
+    'regions': ('c.Region', 'c.Region'),
+}
+
+# area kind -> (Countries column, normalisation of the user value)
+AREAS = {
+    'country': ('Alpha2', str.upper),
+    'region': ('Region', str.capitalize),
+}
+
+ORDERS = {'top': 'desc', 'bottom': 'asc'}
+
+# search: the full-text index joined to Bars, see create_search_index. Its
+# default sort is the bm25 rank, where lower means a better match.
+SEARCH_FROM = ' from BarsSearch s join Bars b on b.Id=s.rowid'
+SEARCH_RANK = 's.rank'
+SEARCH_COLUMNS = {'name': 'Name', 'company': 'Company', 'origin': 'Origin'}
+
+def sort_direction(metric, order):
+    ''' SQL direction of the sort for a metric and 'top' or 'bottom'.'''
+    if metric == 'rank':
+        return 'asc' if order == 'top' else 'desc'
+    return ORDERS[order]
+
+# family -> the area filters its commands accept
+AREA_KINDS = {
+    'bars': ('country', 'region'),
+    'companies': ('country', 'region'),
+    'countries': ('region',),
+    'regions': (),
+    'search': ('country', 'region'),
+}
+
+# Materialized aggregates, see create_summaries. CompanySummary holds one row per
+# (company, company location) and serves companies and the sell side of
+# countries/regions; OriginSummary holds one row per bean origin for the source side.
+SUMMARY_TABLES = {
+    'sell': ('CompanySummary', 'LocationId'),
+    'source': ('OriginSummary', 'OriginId'),
+}
+
+SUMMARY_METRICS = {
+    'ratings': (f'round(round(sum(s.RatingSum)/sum(s.RatingCount),{SORT_DIGITS}),1) as AverageRating',
+                f'round(sum(s.RatingSum)/sum(s.RatingCount),{SORT_DIGITS})'),
+    'cocoa': (f'round(round(sum(s.CocoaSum)/sum(s.CocoaCount),{SORT_DIGITS}),2) as AvgCocoaPercent',
+              f'round(sum(s.CocoaSum)/sum(s.CocoaCount),{SORT_DIGITS})'),
+    'number_of_bars': ('sum(s.BarCount) as NumberOfBars', 'NumberOfBars'),
+}
+
+def _keyset_disjuncts(columns, nulls, bounded=False):
+    # One term per column: rows equal to the key on the columns before it and
+    # sorting after it on this one. SQLite sorts NULL first ascending and last
+    # descending, so nothing sorts after a NULL on a descending column.
+    if bounded and not nulls[0]:
+        yield None, [0]
+    for index, (expression, direction) in enumerate(columns):
+        if direction == 'desc' and nulls[index]:
+            continue
+        terms, binds = [], []
+        for before, (equal, _) in enumerate(columns[:index]):
+            if nulls[before]:
+                terms.append(f'{equal} is null')
+            else:
+                terms.append(f'{equal}=?')
+                binds.append(before)
+        if nulls[index]:
+            terms.append(f'{expression} is not null')
+        elif direction == 'asc':
+            terms.append(f'{expression}>?')
+            binds.append(index)
+        elif bounded:
+            terms.append(f'{expression}<?')
+            binds.append(index)
+        else:
+            terms.append(f'({expression}<? or {expression} is null)')
+            binds.append(index)
+        yield ' and '.join(terms), binds
+
+def keyset_predicate(columns, nulls, bounded=False):
+    ''' SQL matching the rows that come after a key in an ORDER BY
+
+    Parameters
+    ----------
+    columns: tuple
+        (expression, 'asc' or 'desc') for every ORDER BY column
+    nulls: tuple
+        whether each value of the key is NULL; NULL values bind no parameter
+    bounded: bool
+        also limit the first column to a range starting at the key, so an
+        index on it can seek there. Rows with NULL in a descending first
+        column then no longer match and must be fetched separately.
+
+    Returns
+    -------
+    string
+        a condition whose parameters come from keyset_parameters
+    '''
+    terms = [sql for sql, _ in _keyset_disjuncts(columns, nulls, bounded) if sql is not None]
+    predicate = '(' + ' or '.join(terms) + ')' if terms else '0'
+    if bounded and not nulls[0]:
+        expression, direction = columns[0]
+        predicate = f"{expression}{'<=' if direction == 'desc' else '>='}? and {predicate}"
+    return predicate
+
+def keyset_parameters(directions, key, bounded=False):
+    ''' Bind parameters for keyset_predicate, given the ORDER BY directions and the key.'''
+    columns = [('', direction) for direction in directions]
+    nulls = [value is None for value in key]
+    return [key[index] for _, binds in _keyset_disjuncts(columns, nulls, bounded) for index in binds]
+
+@functools.lru_cache(maxsize=None)
+def query_template(family, metric, source, area, order, summary=False, keyset=None):
+    ''' Builds the SQL text for one query shape.
+
+    Parameters
+    ----------
+    family: string
+        'bars', 'companies', 'countries', 'regions' or 'search'
+    metric: string
+        'ratings', 'cocoa', 'number_of_bars' or, for search, 'rank'
+    source: string
+        'sell' joins countries on the company location, 'source' on the bean origin
+    area: string
+        'none', 'country' or 'region'
+    order: string
+        'top' or 'bottom'
+    summary: bool
+        read the aggregate families from the materialized summary tables
+    keyset: tuple
+        for paging: add the sort key (value, tiebreaker) as two extra columns
+        and, unless empty, only return rows after a key whose values are
+        NULL where keyset is true, see keyset_predicate. The bars predicate
+        is bounded.
+
+    Returns
+    -------
+    string
+        a SQL statement binding the search terms (for search), the area
+        value (unless area is 'none'), the keyset parameters and the limit
+    '''
+    direction = sort_direction(metric, order)
+    if family in ('bars', 'search'):
+        conditions = []
+        select = BARS_SELECT
+        bar_sort = SEARCH_RANK if metric == 'rank' else METRICS[metric][0]
+        if family == 'search':
+            select = select.replace(' from Bars b', SEARCH_FROM, 1)
+            conditions.append('BarsSearch match ?')
+        if area != 'none':
+            alias = 'o' if source == 'source' else 'c'
+            conditions.append(f'{alias}.{AREAS[area][0]}=?')
+        if keyset is not None:
+            select = select.replace(' from ', f',{bar_sort},b.Id from ', 1)
+            if keyset:
+                conditions.append(keyset_predicate(((bar_sort, direction), ('b.Id', 'asc')), keyset,
+                                                   bounded=family == 'bars'))
+        where = ' where ' + ' and '.join(conditions) if conditions else ''
+        return f'{select}{where} order by {bar_sort} {direction},b.Id limit ?'
+
+    bar_sort, aggregate, aggregate_sort = METRICS[metric]
+    columns, key = GROUPS[family]
+    where = f' where c.{AREAS[area][0]}=?' if area != 'none' else ''
+    if summary:
+        table, join = SUMMARY_TABLES['source' if source == 'source' and family != 'companies' else 'sell']
+        aggregate, aggregate_sort = SUMMARY_METRICS[metric]
+        columns, key = columns.replace('b.', 's.'), key.replace('b.', 's.')
+        having, sort_value = 'sum(s.BarCount)>4', 'sum(s.BarCount)'
+        tables = f'{table} s left join Countries c on s.{join}=c.Id'
+    else:
+        join = 'BroadBeanOriginId' if source == 'source' and family != 'companies' else 'CompanyLocationId'
+        having, sort_value = 'count(b.Id)>4', 'count(b.Id)'
+        tables = f'Bars b left join Countries c on b.{join}=c.Id'
+    if metric != 'number_of_bars':
+        sort_value = aggregate_sort
+    if keyset is not None:
+        aggregate = f'{aggregate},{sort_value},{key}'
+        if keyset:
+            having += ' and ' + keyset_predicate(((sort_value, direction), (key, 'asc')), keyset)
+    return f'select {columns},{aggregate} from {tables}{where} \
+group by {key} having {having} order by {aggregate_sort} {direction},{key} limit ?'
+
+# Command parsing. A command string is tokenized once into a
+# QueryPlan; validation, SQL generation, caching, formatting and plotting all
+# work from the plan.
+COMMAND_OPTIONS = {
+    'bars': ['none','sell','source','ratings','cocoa','top','bottom','barplot'],
+    'companies': ['none','number_of_bars','ratings','cocoa','top','bottom','barplot'],
+    'countries': ['none','sell','source','number_of_bars','ratings','cocoa','top','bottom','barplot'],
+    'regions': ['sell','source','number_of_bars','ratings','cocoa','top','bottom','barplot'],
+    'search': ['none','sell','source','rank','ratings','cocoa','top','bottom','barplot'],
+}
+
+AREA_PATTERNS = {
+    'country': re.compile('[a-z]{2}', re.IGNORECASE),
+    'region': re.compile('[a-z]+', re.IGNORECASE),
+}
+
+class CommandError(ValueError):
+    '''Raised for a command string that does not follow the command grammar.'''
+
+class SearchUnavailable(RuntimeError):
+    '''Raised for a search command on a database without the full-text index.'''
+    def __init__(self):
+        super().__init__("Search needs the full-text index. Build it with 'python proj3_choc.py --build-search', "
+                         "with the same --shard options when searching shards.")
+
+class QueryPlan(collections.namedtuple('QueryPlan',
+        'family metric source area area_value order limit barplot terms',
+        defaults=('bars', 'ratings', 'sell', 'none', None, 'top', 10, False, None))):
+    '''A parsed command. Plans are immutable and hashable, and two commands
+    that ask for the same rows parse to equal plans.
+
+    Instance Attributes
+    -------------------
+    family: string
+        'bars', 'companies', 'countries', 'regions' or 'search'
+    metric: string
+        'ratings', 'cocoa', 'number_of_bars' or, for search, 'rank'
+    source: string
+        'sell' or 'source'
+    area: string
+        'none', 'country' or 'region'
+    area_value: string
+        normalized Alpha2 code or region name, None without an area filter
+    order: string
+        'top' or 'bottom'
+    limit: int
+        number of rows to return
+    barplot: bool
+        whether to draw the result
+    terms: string
+        FTS5 query of a search command, None for the other families
+    '''
+    __slots__ = ()
+
+    @property
+    def key(self):
+        ''' The plan without presentation options, used as the result cache key.'''
+        return self._replace(barplot=False) if self.barplot else self
+
+    @property
+    def percent_column(self):
+        ''' Index of the column shown as a percentage, or None.'''
+        if self.family in ('bars', 'search'):
+            return 4
+        return -1 if self.metric == 'cocoa' else None
+
+    @property
+    def columns(self):
+        ''' Names of the result columns, as used by the csv, ndjson, npy and arrow formats.'''
+        if self.family in ('bars', 'search'):
+            return ('SpecificBeanBarName', 'Company', 'CompanyLocation', 'Rating', 'CocoaPercent', 'BroadBeanOrigin')
+        metric = METRICS[self.metric][1].rpartition(' as ')[2]
+        return {
+            'companies': ('Company', 'CompanyLocation', metric),
+            'countries': ('Country', 'Region', metric),
+            'regions': ('Region', metric),
+        }[self.family]
+
+    @property
+    def plot_columns(self):
+        ''' (x, y) column indexes for the bar plot.'''
+        if self.family in ('bars', 'search'):
+            return 0, 4 if self.metric == 'cocoa' else 3
+        return 0, 1 if self.family == 'regions' else 2
+
+SEARCH_WORDS = re.compile(r'(?:\w+:)?"[^"]*"|\S+')
+
+def search_term(word, options):
+    ''' Turns one word of a search command into an FTS5 phrase
+
+    A word may name the column to search in ('company:bonnat'), end with
+    '*' to match any word starting with it, or be a double-quoted phrase,
+    which is never read as an option.
+
+    Parameters
+    ----------
+    word: string
+        one word of the command
+    options: list
+        the words search accepts as options
+
+    Returns
+    -------
+    string
+        the FTS5 query for the word, or None if it is an option
+
+    Raises
+    ------
+    CommandError
+        if the word has nothing to search for
+    '''
+    column = None
+    if word.startswith('"'):
+        text, prefix = word.strip('"'), False
+    else:
+        kind = word.partition('=')[0].lower()
+        if '=' in word or (kind.isascii() and kind.isdigit()) or kind in options:
+            return None
+        name, colon, text = word.partition(':')
+        if colon and name.lower() in SEARCH_COLUMNS:
+            column = SEARCH_COLUMNS[name.lower()]
+        else:
+            text = word
+        prefix = text.endswith('*')
+        text = text.rstrip('*')
+        if column and text.startswith('"'):
+            text, prefix = text.strip('"'), False
+    if not text.strip():
+        raise CommandError(word)
+    phrase = '"' + text.replace('"', '""') + '"' + ('*' if prefix else '')
+    return f'{column}:{phrase}' if column else phrase
+
+def parse_command(command, family=None):
+    ''' Parses a command string into a QueryPlan in a single pass over its words
+
+    Parameters
+    ----------
+    command: string
+        The command string represents a query that the user want to run;
+        an empty string means 'bars'
+    family: string
+        parse the options for this family whatever the first word says
+
+    Returns
+    -------
+    QueryPlan
+        the parsed command
+
+    Raises
+    ------
+    CommandError
+        if the command uses an unknown word or an option its family does not accept
+    '''
+    words = command.split()
+    identifier = words[0].lower() if words else 'bars'
+    named = identifier in COMMAND_OPTIONS
+    if not named and family is None:
+        raise CommandError(command)
+    family = family or identifier
+    if family == 'search':
+        words = SEARCH_WORDS.findall(command)
+    if named:
+        words = words[1:]
+    allowed = COMMAND_OPTIONS[family]
+    options = {}
+    terms = []
+    for word in words:
+        if family == 'search':
+            term = search_term(word, allowed)
+            if term is not None:
+                terms.append(term)
+                continue
+        kind, equals, value = word.partition('=')
+        kind = kind.lower()
+        if equals:
+            if kind not in AREA_KINDS[family] or 'area_value' in options or not AREA_PATTERNS[kind].fullmatch(value):
+                raise CommandError(command)
+            options['area'] = kind
+            options['area_value'] = AREAS[kind][1](value)
+        elif kind.isascii() and kind.isdigit():
+            options.setdefault('limit', int(kind))
+        elif kind not in allowed:
+            raise CommandError(command)
+        elif kind in METRICS or kind == 'rank':
+            options.setdefault('metric', kind)
+        elif kind in ORDERS:
+            options.setdefault('order', kind)
+        elif kind in ('sell', 'source'):
+            options.setdefault('source', kind)
+        elif kind == 'barplot':
+            options['barplot'] = True
+    if family == 'search':
+        if not terms:
+            raise CommandError(command)
+        options['terms'] = ' '.join(terms)
+        options.setdefault('metric', 'rank')
+    return QueryPlan(family=family, **options)
+
+def as_plan(command, family=None):
+    ''' Returns command unchanged if it already is a QueryPlan, else parses it.'''
+    if isinstance(command, QueryPlan):
+        return command
+    return parse_command(command, family)
+
+def plan_query(plan):
+    ''' Returns the SQL template and bind parameters for a plan
+
+    Parameters
+    ----------
+    plan: QueryPlan
+        a parsed command
+
+    Returns
+    -------
+    tuple
+        (sql, parameters)
+    '''
+    summary = plan.family not in ('bars', 'search') and summaries_available()
+    sql = query_template(plan.family, plan.metric, plan.source, plan.area, plan.order, summary)
+    return sql, tuple(_leading_parameters(plan) + [plan.limit])
+
+def _leading_parameters(plan):
+    # Parameters bound before the keyset and the limit.
+    parameters = []
+    if plan.family == 'search':
+        # ShardSet.execute checks the shards.
+        if not SHARDS and not search_available():
+            raise SearchUnavailable()
+        parameters.append(plan.terms)
+    if plan.area != 'none':
+        parameters.append(plan.area_value)
+    return parameters
+
+def _uses_sqlite(plan):
+    # Shards take every plan; the columnar backend has no text search.
+    return not SHARDS and (BACKEND == 'sqlite' or plan.family == 'search')
+
+def fetch_plan(plan):
+    ''' Returns the rows for a plan as a list, from the result cache when possible.
+    With SHARDS set the plan runs over the shards, whatever the backend.
+    '''
+    if not _uses_sqlite(plan):
+        cache = get_result_cache()
+        results, stamp = cache.lookup(plan.key)
+        if results is None:
+            results = get_shard_set().execute(plan) if SHARDS else columnar_fetch(plan)
+            cache.put(plan.key, results, stamp)
+        return results
+    return cached_fetch_db(*plan_query(plan), key=plan.key)
+
+def stream_plan(plan):
+    ''' Yields the rows for a plan, fetching them from the cursor in chunks.'''
+    if not _uses_sqlite(plan):
+        return iter(fetch_plan(plan))
+    return stream_db(*plan_query(plan), key=plan.key)
+
+# Sharded execution. Bars may be split over several SQLite files, for
+# example by region or review year; every shard holds the same Countries
+# table and Bars ids are unique across shards. Commands run on all shards
+# in parallel and the partial results are merged: bars by a k-way merge of
+# each shard's top rows, the aggregate families by gathering per-group
+# sums and counts into in-memory summary tables (see create_summaries) and
+# running the summary query there, so the threshold and ordering are
+# applied after the merge.
+SHARDS = [path for path in os.environ.get('CHOC_SHARDS', '').split(os.pathsep) if path] or None
+
+class ShardWatcher:
+    '''Detects changes to any of several database files, see DatabaseWatcher.'''
+    def __init__(self, paths):
+        self.watchers = [DatabaseWatcher(path) for path in paths]
+
+    def stamp(self):
+        return tuple(watcher.stamp() for watcher in self.watchers)
+
+    def close(self):
+        for watcher in self.watchers:
+            watcher.close()
+
+def _shard_table(plan):
+    return SUMMARY_TABLES['source' if plan.source == 'source' and plan.family != 'companies' else 'sell'][0]
+
+def shard_query(plan):
+    ''' Returns the SQL and bind parameters a single shard runs for a plan:
+    the plan's own query with b.Id and the sort value prepended for bars and
+    search, otherwise rating and cocoa sums and counts per summary table key.
+    '''
+    if plan.family in ('bars', 'search'):
+        sql, parameters = plan_query(plan)
+        value = SEARCH_RANK if plan.metric == 'rank' else METRICS[plan.metric][0]
+        return sql.replace('select ', f'select b.Id,{value},', 1), parameters
+    if _shard_table(plan) == 'OriginSummary':
+        join, keys = 'BroadBeanOriginId', 'ifnull(b.BroadBeanOriginId,0)'
+    else:
+        company = 'b.Company' if plan.family == 'companies' else "''"
+        join, keys = 'CompanyLocationId', f'{company},ifnull(b.CompanyLocationId,0)'
+    where, parameters = '', ()
+    if plan.area != 'none':
+        where = f' join Countries c on b.{join}=c.Id where c.{AREAS[plan.area][0]}=?'
+        parameters = (plan.area_value,)
+    return f'select {keys},total(b.Rating),count(b.Rating),total(b.CocoaPercent),count(b.CocoaPercent),count(*) \
+from Bars b{where} group by {keys}', parameters
+
+def _bar_sort_key(plan):
+    # Shard rows start with b.Id and the sort value. SQLite sorts NULL below
+    # every number: last descending, first ascending.
+    if sort_direction(plan.metric, plan.order) == 'desc':
+        return lambda row: (row[1] is None, -(row[1] or 0), row[0])
+    return lambda row: (row[1] is not None, row[1] or 0, row[0])
+
+def _gather_database(countries):
+    # An in-memory database with the schema, the summary tables and a copy
+    # of Countries, ready to merge partial sums into.
+    gather = sqlite3.connect(':memory:', check_same_thread=False)
+    create_schema(gather)
+    for statement in summary_schema():
+        gather.execute(statement)
+    gather.executemany('insert into Countries values (?,?,?,?,?,?,?,?)', countries)
+    return gather
+
+def _merge_partials(gather, table, rows):
+    # Adds rows of (key..., RatingSum, RatingCount, CocoaSum, CocoaCount, BarCount) to a summary table.
+    keys = ','.join(name for name, _ in SUMMARY_KEYS[table])
+    gather.executemany(f"insert into {table} ({keys},RatingSum,RatingCount,CocoaSum,CocoaCount,BarCount) \
+values ({','.join('?' * (len(SUMMARY_KEYS[table]) + 5))}) on conflict ({keys}) do update set \
+RatingSum=RatingSum+excluded.RatingSum,RatingCount=RatingCount+excluded.RatingCount,\
+CocoaSum=CocoaSum+excluded.CocoaSum,CocoaCount=CocoaCount+excluded.CocoaCount,BarCount=BarCount+excluded.BarCount", rows)
+
+class ShardSet:
+    '''Several databases queried together as one.
+
+    Instance Attributes
+    -------------------
+    paths: list
+        database file of every shard
+    '''
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.pools = [ConnectionPool(path) for path in self.paths]
+        self._executor = concurrent.futures.ThreadPoolExecutor(len(self.paths), thread_name_prefix='shard')
+
+    def _fetch(self, pool, sql, parameters):
+        start = time.perf_counter()
+        with pool.connection() as connection:
+            rows = connection.execute(sql, parameters).fetchall()
+        instrumentation.record_statement(sql, time.perf_counter() - start, len(rows))
+        return rows
+
+    def scatter(self, sql, parameters=()):
+        ''' Runs a query on every shard in parallel and returns the list of results.'''
+        return list(self._executor.map(lambda pool: self._fetch(pool, sql, parameters), self.pools))
+
+    def search_available(self):
+        ''' Whether every shard has the search table and its triggers.'''
+        return all(rows[0][0] == len(SEARCH_OBJECTS) for rows in self.scatter(SEARCH_OBJECTS_QUERY, SEARCH_OBJECTS))
+
+    def execute(self, plan):
+        ''' Returns the rows a single database holding every shard's bars would return for a plan.'''
+        if plan.family == 'search' and not self.search_available():
+            raise SearchUnavailable()
+        partials = self.scatter(*shard_query(plan))
+        if plan.family in ('bars', 'search'):
+            merged = heapq.merge(*partials, key=_bar_sort_key(plan))
+            return [row[2:] for row in itertools.islice(merged, plan.limit)]
+        gather = _gather_database(self._fetch(self.pools[0], 'select * from Countries', ()))
+        try:
+            for rows in partials:
+                _merge_partials(gather, _shard_table(plan), rows)
+            sql = query_template(plan.family, plan.metric, plan.source, plan.area, plan.order, summary=True)
+            parameters = (plan.area_value, plan.limit) if plan.area != 'none' else (plan.limit,)
+            return gather.execute(sql, parameters).fetchall()
+        finally:
+            gather.close()
+
+    def close(self):
+        self._executor.shutdown()
+        for pool in self.pools:
+            pool.close()
+
+_shard_set = None
+
+def set_shards(paths):
+    ''' Runs commands over the given database files instead of DBNAME, or
+    over DBNAME again when paths is empty or None.
+    '''
+    global SHARDS, _shard_set
+    with _pool_lock:
+        old, _shard_set = _shard_set, None
+        SHARDS = list(paths) if paths else None
+        cache = _result_cache
+    if old is not None:
+        old.close()
+    if cache is not None:
+        if cache.watcher is not None:
+            cache.watcher.close()
+        cache.watcher = _cache_watcher()
+        cache.clear()
+
+def get_shard_set():
+    ''' Returns the ShardSet over SHARDS, creating it on first use.'''
+    global _shard_set
+    if _shard_set is None:
+        with _pool_lock:
+            if _shard_set is None:
+                _shard_set = ShardSet(SHARDS)
+    return _shard_set
+
+# Fused summaries. Reports that run every metric for companies, countries and
+# regions would scan Bars once per command. A Summary scans it once per join
+# side instead (or reads the summary tables, when the database has them),
+# keeps the per-key sums and counts in memory and answers every aggregate
+# command from them.
+SUMMARY_VIEWS = (('companies', 'sell'), ('countries', 'sell'), ('countries', 'source'),
+                 ('regions', 'sell'), ('regions', 'source'))
+
+class Summary:
+    '''Average rating, average cocoa percentage and number of bars for every
+    company, country and region, on both the sell and the source side.
+
+    Instance Attributes
+    -------------------
+    None
+    '''
+    def __init__(self, countries, partials):
+        ''' countries are the rows of Countries; partials maps each summary
+        table to its rows of (key..., RatingSum, RatingCount, CocoaSum,
+        CocoaCount, BarCount), possibly with repeated keys.
+        '''
+        self._database = _gather_database(countries)
+        self._lock = threading.Lock()
+        for table, rows in partials.items():
+            _merge_partials(self._database, table, rows)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._database.execute(sql, parameters).fetchall()
+
+    def view(self, command):
+        ''' Returns the rows of a companies, countries or regions command,
+        the same rows fetch_plan returns for it.
+
+        Parameters
+        ----------
+        command: string or QueryPlan
+            the command to answer
+
+        Returns
+        -------
+        list
+            a list of tuples that represent the query result
+        '''
+        plan = as_plan(command)
+        if plan.family not in GROUPS:
+            raise ValueError(f'a summary has no {plan.family} view')
+        sql = query_template(plan.family, plan.metric, plan.source, plan.area, plan.order, summary=True)
+        parameters = (plan.area_value, plan.limit) if plan.area != 'none' else (plan.limit,)
+        return self._execute(sql, parameters)
+
+    def table(self, family, source='sell'):
+        ''' Returns every group of a family with more than four bars, with
+        all three metrics, ordered by the group key.
+
+        Parameters
+        ----------
+        family: string
+            'companies', 'countries' or 'regions'
+        source: string
+            'sell' or 'source'; companies are always grouped on the sell side
+
+        Returns
+        -------
+        list
+            tuples of the family's columns followed by AverageRating,
+            AvgCocoaPercent and NumberOfBars
+        '''
+        table, join = SUMMARY_TABLES['source' if source == 'source' and family != 'companies' else 'sell']
+        columns, key = (part.replace('b.', 's.') for part in GROUPS[family])
+        aggregates = ','.join(SUMMARY_METRICS[metric][0] for metric in METRICS)
+        return self._execute(f'select {columns},{aggregates} from {table} s left join Countries c \
+on s.{join}=c.Id group by {key} having sum(s.BarCount)>4 order by {key}')
+
+    @staticmethod
+    def layout(family):
+        ''' Column names of Summary.table for a family, as a RowLayout.'''
+        columns = QueryPlan(family, 'number_of_bars').columns[:-1]
+        metrics = tuple(METRICS[metric][1].rpartition(' as ')[2] for metric in METRICS)
+        return RowLayout(columns + metrics, -2)
+
+    def close(self):
+        self._database.close()
+
+def summary_scan(table):
+    ''' SQL for one grouped scan of Bars giving the rows of a summary table.'''
+    values = ','.join(expression.format(row='b') for _, expression in SUMMARY_KEYS[table])
+    return f'select {values},total(b.Rating),count(b.Rating),total(b.CocoaPercent),count(b.CocoaPercent),count(*) \
+from Bars b group by {values}'
+
+def fetch_summary():
+    ''' Returns a Summary of DBNAME, or of every shard with SHARDS set. The
+    scans are cached like query results.
+    '''
+    cache = get_result_cache()
+    partials = {}
+    if SHARDS:
+        shards = get_shard_set()
+        for table in SUMMARY_KEYS:
+            rows, stamp = cache.lookup(('summary', table))
+            if rows is None:
+                rows = [row for part in shards.scatter(summary_scan(table)) for row in part]
+                cache.put(('summary', table), rows, stamp)
+            partials[table] = rows
+        countries = shards._fetch(shards.pools[0], 'select * from Countries', ())
+    else:
+        stored = summaries_available()
+        for table, keys in SUMMARY_KEYS.items():
+            if stored:
+                names = ','.join(name for name, _ in keys)
+                sql = f'select {names},RatingSum,RatingCount,CocoaSum,CocoaCount,BarCount from {table}'
+            else:
+                sql = summary_scan(table)
+            partials[table] = cached_fetch_db(sql)
+        countries = cached_fetch_db('select * from Countries')
+    return Summary(countries, partials)
+
+def format_summary(summary=None, fmt=None):
+    ''' Formats every table of a summary (by default, of the current
+    database): as fixed width tables under a title each, or in csv or
+    ndjson with the title in a leading View column. fmt defaults as in
+    write_rows.
+    '''
+    fmt = fmt or (OUTPUT_FORMAT if OUTPUT_FORMAT in TEXT_FORMATS else 'table')
+    own = summary is None
+    if own:
+        summary = fetch_summary()
+    out = io.StringIO()
+    try:
+        for family, source in SUMMARY_VIEWS:
+            title = family if family == 'companies' else f'{family} {source}'
+            layout = Summary.layout(family)
+            rows = summary.table(family, source)
+            if fmt == 'table':
+                out.write(title + '\n')
             else:
-                yval=[result[3] for result in results]
-                bar_plot(xval,yval)
-
-    elif identifier == 'countries':
-        results = Command().countries(command)
-        if 'barplot' in command:
-            xval = [result[0] for result in results]
-            yval = [result[2] for result in results]
-            bar_plot(xval,yval)
-
-    elif identifier == 'companies':
-        results = Command().companies(command)
-        if 'barplot' in command:
-            xval = [result[0] for result in results]
-            yval = [result[2] for result in results]
-            bar_plot(xval,yval)
+                layout = layout._replace(columns=('View',) + layout.columns)
+                rows = ((title,) + row for row in rows)
+            write_rows(layout, rows, out, fmt=fmt)
+    finally:
+        if own:
+            summary.close()
+    return out.getvalue()[:-1]
 
-    else:
-        results = Command().regions(command)
-        if 'barplot' in command:
-            xval = [result[0] for result in results]
-            yval = [result[1] for result in results]
-            bar_plot(xval,yval)        
-    return results
+# Paging. The prompt shows a command's results a page of `limit` rows at a
+# time. Each page after the first only asks for rows sorting after the last
+# row of the page before it (its value and tiebreaker, the keyset), so a deep
+# page costs the same as the first one instead of rescanning skipped rows.
+def page_query(plan, after=None):
+    ''' Returns the SQL and bind parameters for one page of a plan
 
-def print_query_result(command):
-    ''' Pretty prints raw query result 
-    
     Parameters
     ----------
-    command: string
-        The command string represents a query that the user want to run
-    
+    plan: QueryPlan
+        a parsed command; its limit is the page size
+    after: tuple
+        (value, tiebreaker) of the last row of the previous page, or None
+        for the first page
+
     Returns
     -------
-    None
+    tuple
+        (sql, parameters); every row ends with its (value, tiebreaker) key
     '''
-    results_list = process_command(command)
-    identifier = command.split(' ')[0]
-    format_list=[]
-    if identifier == 'bars':
-        for results in results_list:
-            results=list(results)
-            results[4]='{:.0%}'.format(results[4])
-            results=tuple(results)
-            format_list.append(results)
-        results_list=format_list
-    else:
-        if 'cocoa' in command:
-            for results in results_list:
-                results=list(results)
-                if len(results) == 3:
-                    results[2]='{:.0%}'.format(results[2])
-                    results=tuple(results)
-                    format_list.append(results)
-                else:
-                    results[1]='{:.0%}'.format(results[1])
-                    results=tuple(results)
-                    format_list.append(results)
-            results_list=format_list
-        
-    pd.set_option('max_colwidth',16)
-    df= pd.DataFrame(results_list)
-    return df.to_string(index=False,header=False,max_colwidth=16)
+    summary = plan.family not in ('bars', 'search') and summaries_available()
+    keyset = () if after is None else tuple(value is None for value in after)
+    sql = query_template(plan.family, plan.metric, plan.source, plan.area, plan.order, summary, keyset)
+    parameters = _leading_parameters(plan)
+    if after is not None:
+        parameters += keyset_parameters((sort_direction(plan.metric, plan.order), 'asc'), after,
+                                        bounded=plan.family == 'bars')
+    return sql, tuple(parameters + [plan.limit])
+
+class Pager:
+    '''Walks through the results of a command one page at a time.
+
+    Pages are streamed from the cursor like write_query_result does; read
+    each page to the end before moving to another one.
+
+    Instance Attributes
+    -------------------
+    plan: QueryPlan
+        the command being paged
+    page: int
+        number of the current page, starting at 0
+    '''
+    def __init__(self, plan):
+        self.plan = plan.key
+        self.page = 0
+        self._starts = [None]
+        self._last = None
+        self._full = False
+
+    def _stream(self, after):
+        # Yields the page's rows without their key columns; once they are all
+        # read, _last holds the key of the last one and _full whether the page
+        # was a whole page.
+        self._full = False
+        count, key = 0, None
+        if not _uses_sqlite(self.plan):
+            # Those backends have no SQL to add the keyset to; fall back to a longer limit.
+            size = self.plan.limit
+            start = size * (len(self._starts) - 1)
+            for row in fetch_plan(self.plan._replace(limit=start + size))[start:]:
+                count += 1
+                yield row
+        else:
+            for row in stream_db(*page_query(self.plan, after)):
+                count += 1
+                key = row[-2:]
+                yield row[:-2]
+            if (self.plan.family == 'bars' and self.plan.order == 'top' and after is not None
+                    and after[0] is not None and count < self.plan.limit):
+                # The bounded bars predicate leaves out the NULL values sorted last.
+                tail = self.plan._replace(limit=self.plan.limit - count)
+                for row in stream_db(*page_query(tail, (None, 0))):
+                    count += 1
+                    key = row[-2:]
+                    yield row[:-2]
+        self._last = key
+        self._full = count == self.plan.limit
+
+    def _open(self, after):
+        # Starts streaming a page; None if it has no rows.
+        rows = self._stream(after)
+        first = next(rows, None)
+        if first is None:
+            return None
+        return itertools.chain((first,), rows)
+
+    def first(self):
+        ''' Returns an iterator over the rows of the first page.'''
+        del self._starts[1:]
+        self.page = 0
+        return self._open(None) or iter(())
+
+    def next(self):
+        ''' Moves to the next page and returns an iterator over its rows, or
+        returns None when the current page is the last one.
+        '''
+        if not self._full:
+            return None
+        self._starts.append(self._last)
+        rows = self._open(self._last)
+        if rows is None:
+            self._starts.pop()
+            return None
+        self.page += 1
+        return rows
+
+    def prev(self):
+        ''' Moves to the previous page and returns an iterator over its rows,
+        or returns None on the first page.
+        '''
+        if self.page == 0:
+            return None
+        self._starts.pop()
+        self.page -= 1
+        return self._open(self._starts[-1]) or iter(())
 
 class Command:
-    '''A command.
+    '''A command. Each method parses its command string once and runs the
+    resulting plan; Command holds no state, so one instance can be shared
+    between threads.
 
     Instance Attributes
     -------------------
     None
     '''
-    def __init__(self):
-        self.areas = 'none'
-        self.sources = 'sell'
-        self.filters = 'b.Rating'
-        self.orders = 'desc'
-        self.integer = 10
-
     def bars(self,command):
         ''' Constructs and executes SQL query to retrieve data 
         based on the high level command bars, and its valid options
         
         Parameters
         ----------
-        command: string
+        command: string or QueryPlan
             The command string represents a query that the user want to run
 
         Returns
@@ -135,50 +2226,15 @@ class Command:
         list
             a list of tuples that represent the query result
         '''
-        select = f"select b.SpecificBeanBarName,b.Company,c.EnglishName,b.Rating,b.CocoaPercent,o.EnglishName from Bars b \
-                   left join Countries c on b.CompanyLocationId = c.Id left join Countries o on b.BroadBeanOriginId=o.Id"
-        parameter_num = command.split(' ')
-        area_index = [key for key,val in enumerate(parameter_num) if 'country' in val or 'region' in val]
-        filter_index =[key for key,val in enumerate(parameter_num) if 'cocoa' in val or 'ratings' in val]
-        order_index = [key for key,val in enumerate(parameter_num) if 'top' in val or 'bottom' in val]
-        integer_index =[key for key,val in enumerate(parameter_num) if val.isnumeric() == True]
-
-        if area_index:
-            area = parameter_num[area_index[0]].split('=')[1]
-            if parameter_num[area_index[0]].split('=')[0] == 'country':
-                if 'source' in command:
-                    self.areas = f'o.Alpha2=\'{area.upper()}\''
-                else:
-                    self.areas= f'c.Alpha2=\'{area.upper()}\''
-            else:
-                if 'source' in command:
-                    self.areas = f'o.Region=\'{area.capitalize()}\''
-                else:
-                    self.areas = f'c.Region=\'{area.capitalize()}\''
-
-        if filter_index:
-            if parameter_num[filter_index[0]] == 'cocoa':
-                self.filters = 'b.CocoaPercent'
-
-        if order_index:
-            if parameter_num[order_index[0]] == 'bottom':
-                self.orders = 'asc'
-        
-        if integer_index:
-            self.integer = parameter_num[integer_index[0]]
-        
-        if 'country' in command or 'region' in command:
-            return fetch_db(select+f' where {self.areas} order by {self.filters} {self.orders} limit {self.integer}')
-        else:
-            return fetch_db(select+f' order by {self.filters} {self.orders} limit {self.integer}')
+        return fetch_plan(as_plan(command, 'bars'))
 
     def companies(self,command):
         ''' Constructs and executes SQL query to retrieve data 
-        based on the high level command countries, and its valid options
+        based on the high level command companies, and its valid options
         
         Parameters
         ----------
-        command: string
+        command: string or QueryPlan
             The command string represents a query that the user want to run
 
         Returns
@@ -186,66 +2242,7 @@ class Command:
         list
             a list of tuples that represent the query result
         '''
-        parameter_num = command.split(' ')
-        area_index = [key for key,val in enumerate(parameter_num) if 'country' in val or 'region' in val]
-        filter_index =[key for key,val in enumerate(parameter_num) if 'cocoa' in val or 'ratings' in val or 'number_of_bars' in val]
-        order_index = [key for key,val in enumerate(parameter_num) if 'top' in val or 'bottom' in val]
-        integer_index =[key for key,val in enumerate(parameter_num) if val.isnumeric() == True]
-
-        if area_index:
-            area = parameter_num[area_index[0]].split('=')[1]
-            if parameter_num[area_index[0]].split('=')[0] == 'country':
-                self.areas = f'c.Alpha2=\'{area.upper()}\''
-            else:
-                self.areas = f'c.Region=\'{area.capitalize()}\''
-
-        if filter_index:
-            if parameter_num[filter_index[0]] == 'cocoa':
-                self.filters = 'b.CocoaPercent'
-            elif parameter_num[filter_index[0]] == 'number_of_bars':
-                self.filters = 'b.Id'
-
-        if order_index:
-            if parameter_num[order_index[0]] == 'bottom':
-                self.orders = 'asc'
-        
-        if integer_index:
-            self.integer = parameter_num[integer_index[0]]
-
-        if self.filters == 'b.CocoaPercent':
-            if 'country' in command or 'region' in command:
-                return fetch_db(f'select b.Company,c.EnglishName,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  where {self.areas} group by b.Company having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-            else:
-                return fetch_db(f'select b.Company,c.EnglishName,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by b.Company having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-        elif self.filters == 'b.Id':
-            if 'country' in command or 'region' in command:
-                return fetch_db(f'select b.Company,c.EnglishName,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  where {self.areas} group by b.Company having NumberOfBars>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
-            else:
-                return fetch_db(f'select b.Company,c.EnglishName,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by b.Company having NumberOfBars>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
- 
-        else:
-            if 'country' in command or 'region' in command:
-                return fetch_db(f'select b.Company,c.EnglishName,round(avg({self.filters}),1) as AverageRating \
-                           from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                           where {self.areas} group by b.Company having count(b.Id)>4 \
-                           order by avg({self.filters}) {self.orders} limit {self.integer}')
-            else:
-                return fetch_db(f'select b.Company,c.EnglishName,round(avg({self.filters}),1) as AverageRating \
-                           from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                           group by b.Company having count(b.Id)>4 \
-                           order by avg({self.filters}) {self.orders} limit {self.integer}')
+        return fetch_plan(as_plan(command, 'companies'))
 
     def countries(self,command):
         ''' Constructs and executes SQL query to retrieve data 
@@ -253,7 +2250,7 @@ class Command:
         
         Parameters
         ----------
-        command: string
+        command: string or QueryPlan
             The command string represents a query that the user want to run
 
         Returns
@@ -261,102 +2258,7 @@ class Command:
         list
             a list of tuples that represent the query result
         '''
-        parameter_num = command.split(' ')
-        area_index = [key for key,val in enumerate(parameter_num) if 'region' in val]
-        filter_index =[key for key,val in enumerate(parameter_num) if 'cocoa' in val or 'ratings' in val or 'number_of_bars' in val]
-        order_index = [key for key,val in enumerate(parameter_num) if 'top' in val or 'bottom' in val]
-        integer_index =[key for key,val in enumerate(parameter_num) if val.isnumeric() == True]
-
-        if area_index:
-            area = parameter_num[area_index[0]].split('=')[1]
-            if parameter_num[area_index[0]].split('=')[0] == 'region':
-                self.areas = f'c.Region=\'{area.capitalize()}\''
-
-        if filter_index:
-            if parameter_num[filter_index[0]] == 'cocoa':
-                self.filters = 'b.CocoaPercent'
-            elif parameter_num[filter_index[0]] == 'number_of_bars':
-                self.filters = 'b.Id'
-
-        if order_index:
-            if parameter_num[order_index[0]] == 'bottom':
-                self.orders = 'asc'
-        
-        if integer_index:
-            self.integer = parameter_num[integer_index[0]]
-        
-        if self.filters == 'b.CocoaPercent':
-            if 'region' in command:
-                if 'source' in command:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  where {self.areas} group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-                else:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  where {self.areas} group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-            else:
-                if 'source' in command:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-                else: 
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-
-
-        elif self.filters == 'b.Id':
-            if 'region' in command:
-                if 'source' in command:
-                    return fetch_db(f'select c.EnglishName,c.Region,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  where {self.areas} group by c.Id having NumberofBars>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
-                else:
-                    return fetch_db(f'select c.EnglishName,c.Region,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  where {self.areas} group by c.Id having NumberofBars>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
-            else:
-                if 'source' in command:
-                    return fetch_db(f'select c.EnglishName,c.Region,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  group by c.Id having NumberOfBars>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
-                else:
-                    return fetch_db(f'select c.EnglishName,c.Region,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by c.Id having NumberOfBars>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
-        
-        else:
-            if 'region' in command:
-                if 'source' in command:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),1) as AverageRating \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  where {self.areas} group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-                else:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),1) as AverageRating \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  where {self.areas} group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-            else:
-                if 'source' in command:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),1) as AverageRating \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}') 
-                else:
-                    return fetch_db(f'select c.EnglishName,c.Region,round(avg({self.filters}),1) as AverageRating \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by c.Id having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}') 
+        return fetch_plan(as_plan(command, 'countries'))
 
     def regions(self, command):
         ''' Constructs and executes SQL query to retrieve data 
@@ -364,7 +2266,7 @@ class Command:
         
         Parameters
         ----------
-        command: string
+        command: string or QueryPlan
             The command string represents a query that the user want to run
 
         Returns
@@ -372,142 +2274,1196 @@ class Command:
         list
             a list of tuples that represent the query result
         '''
-        parameter_num = command.split(' ')
-        filter_index =[key for key,val in enumerate(parameter_num) if 'cocoa' in val or 'ratings' in val or 'number_of_bars' in val]
-        order_index = [key for key,val in enumerate(parameter_num) if 'top' in val or 'bottom' in val]
-        integer_index =[key for key,val in enumerate(parameter_num) if val.isnumeric() == True]
-
-        if filter_index:
-            if parameter_num[filter_index[0]] == 'cocoa':
-                self.filters = 'b.CocoaPercent'
-            elif parameter_num[filter_index[0]] == 'number_of_bars':
-                self.filters = 'b.Id'
-
-        if order_index:
-            if parameter_num[order_index[0]] == 'bottom':
-                self.orders = 'asc'
-        
-        if integer_index:
-            self.integer = parameter_num[integer_index[0]]
-       
-        if self.filters == 'b.CocoaPercent':
-            if 'source' in command:
-                return fetch_db(f'select c.Region,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  group by c.Region having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-            else:
-                return fetch_db(f'select c.Region,round(avg({self.filters}),2) as AvgCocoaPercent \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by c.Region having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-
-        elif self.filters == 'b.Id':
-            if 'source' in command:
-                return fetch_db(f'select c.Region,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  group by c.Region having count(b.Id)>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
-            else:
-                return fetch_db(f'select c.Region,count({self.filters}) as NumberOfBars \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by c.Region having count(b.Id)>4 \
-                                  order by NumberOfBars {self.orders} limit {self.integer}')
+        return fetch_plan(as_plan(command, 'regions'))
+
+    def search(self, command):
+        ''' Runs a search command: bars whose name, company or bean origin
+        match its terms, best match first unless sorted by a metric.
+
+        Parameters
+        ----------
+        command: string or QueryPlan
+            The command string represents a query that the user want to run
+
+        Returns
+        -------
+        list
+            a list of tuples that represent the query result
+        '''
+        return fetch_plan(as_plan(command, 'search'))
+
+    def summary(self):
+        ''' Computes every aggregate at once, see Summary. Its view method
+        answers companies, countries and regions commands without running
+        them against the database.
+
+        Returns
+        -------
+        Summary
+            the metrics of every company, country and region
+        '''
+        return fetch_summary()
+
+# Columnar backend. Bars and Countries are loaded once into NumPy
+# arrays and commands are answered with vectorized filters, bincount
+# group-bys and argpartition top-k instead of SQL. Select it with
+# set_backend('columnar') or CHOC_BACKEND=columnar; numpy is only needed then.
+BACKENDS = ('sqlite', 'columnar')
+BACKEND = os.environ.get('CHOC_BACKEND', 'sqlite')
+
+def set_backend(name):
+    ''' Chooses how process_command answers plans: 'sqlite' or 'columnar'.'''
+    global BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'unknown backend {name!r}, expected one of {BACKENDS}')
+    BACKEND = name
+
+class ColumnarStore:
+    '''Bars and Countries held as NumPy column arrays.
+
+    Companies and regions are dictionary encoded as integer codes whose order
+    matches SQLite's text order, and the company location and bean origin of
+    every bar are stored as indexes into the country arrays (-1 for a missing
+    or unknown country).
+
+    Instance Attributes
+    -------------------
+    dbname: string
+        database the arrays were loaded from
+    stamp: tuple
+        database stamp at load time, see DatabaseWatcher
+    '''
+    def __init__(self, dbname=DBNAME):
+        import numpy as np
+        self.np = np
+        self.dbname = dbname
+        self.watcher = DatabaseWatcher(dbname)
+        self.stamp = self.watcher.stamp()
+        connection = connect_writable(dbname)
+        try:
+            self._load(connection)
+        finally:
+            connection.close()
+        self._rounder = sqlite3.connect(':memory:', check_same_thread=False)
+        self._rounder.execute('create table Rounding (Value REAL)')
+        self._rounder_lock = threading.Lock()
+
+    def _load(self, connection):
+        np = self.np
+        countries = connection.execute('select Id,Alpha2,EnglishName,Region from Countries order by Id').fetchall()
+        index_of = {row[0]: index for index, row in enumerate(countries)}
+        self.country_ids = np.array([row[0] for row in countries], dtype=np.float64)
+        self.country_alpha2 = np.array([row[1] for row in countries] + [None], dtype=object)
+        self.country_names = [row[2] for row in countries]
+        # Position of every country's name in name order, for min(c.EnglishName).
+        self.sorted_country_names = sorted({name for name in self.country_names if name is not None})
+        position = {name: index for index, name in enumerate(self.sorted_country_names)}
+        self.country_name_rank = np.array([position.get(name, -1) for name in self.country_names] + [-1],
+                                          dtype=np.int64)
+        self.region_names = sorted({row[3] for row in countries})
+        region_code = {name: code for code, name in enumerate(self.region_names)}
+        self.country_region = np.array([region_code[row[3]] for row in countries] + [-1], dtype=np.int64)
+
+        ids, ratings, cocoa, companies, locations, origins, names = [], [], [], [], [], [], []
+        company_code = {}
+        cursor = connection.execute('select Id,Company,SpecificBeanBarName,Rating,CocoaPercent,\
+CompanyLocationId,BroadBeanOriginId from Bars order by Id')
+        for chunk in iter(lambda: cursor.fetchmany(FETCH_CHUNK_SIZE * 10), []):
+            for bar_id, company, name, rating, percent, location, origin in chunk:
+                ids.append(bar_id)
+                names.append(name)
+                ratings.append(rating)
+                cocoa.append(percent)
+                companies.append(company_code.setdefault(company, len(company_code)))
+                locations.append(index_of.get(location, -1))
+                origins.append(index_of.get(origin, -1))
+        self.ids = np.array(ids, dtype=np.int64)
+        self.names = np.array(names, dtype=object)
+        self.metrics = {
+            'ratings': np.array(ratings, dtype=np.float64),
+            'cocoa': np.array(cocoa, dtype=np.float64),
+        }
+        self.company_names = np.array(list(company_code), dtype=object)
+        self.company_rank = np.argsort(np.argsort(self.company_names.astype(str), kind='stable'))
+        self.companies = np.array(companies, dtype=np.int64)
+        self.joins = {
+            'sell': np.array(locations, dtype=np.int64),
+            'source': np.array(origins, dtype=np.int64),
+        }
+
+    def _area_mask(self, countries, area, value):
+        ''' Rows whose country (an index array, -1 for none) passes a country=/region= filter.'''
+        if area == 'country':
+            match = self.country_alpha2 == value
         else:
-            if 'source' in command:
-                return fetch_db(f'select c.Region,round(avg({self.filters}),1) as AverageRating \
-                                  from Bars b left join Countries c on b.BroadBeanOriginId=c.Id \
-                                  group by c.Region having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
-            else:
-                return fetch_db(f'select c.Region,round(avg({self.filters}),1) as AverageRating \
-                                  from Bars b left join Countries c on b.CompanyLocationId=c.Id \
-                                  group by c.Region having count(b.Id)>4 \
-                                  order by avg({self.filters}) {self.orders} limit {self.integer}')
+            code = self.region_names.index(value) if value in self.region_names else -2
+            match = self.country_region == code
+        match[-1] = False
+        return match[countries]
+
+    def _top(self, candidates, values, tiebreak, order, limit):
+        ''' Orders candidates by value like SQLite (NULLs first ascending, last
+        descending) with tiebreak ascending, and returns the first limit.
+        '''
+        np = self.np
+        values = values[candidates]
+        if order == 'top':
+            key = np.where(np.isnan(values), np.inf, -values)
+        else:
+            key = np.where(np.isnan(values), -np.inf, values)
+        if limit <= 0:
+            return candidates[:0]
+        if limit < len(candidates):
+            kth = key[np.argpartition(key, limit - 1)[limit - 1]]
+            keep = key <= kth
+            candidates, key = candidates[keep], key[keep]
+        return candidates[np.lexsort((tiebreak[candidates], key))[:limit]]
+
+    def _round(self, values, digits):
+        # SQLite's round() does not round like Python's, so let SQLite do it.
+        with self._rounder_lock:
+            self._rounder.execute('delete from Rounding')
+            self._rounder.executemany('insert into Rounding values (?)', ((value,) for value in values))
+            return [row[0] for row in self._rounder.execute('select round(Value,?) from Rounding order by rowid',
+                                                            (digits,))]
+
+    def _value(self, value):
+        return None if value != value else value
+
+    def execute(self, plan):
+        ''' Returns the rows SQLite would return for a plan.'''
+        np = self.np
+        join = 'source' if plan.source == 'source' and plan.family != 'companies' else 'sell'
+        countries = self.joins[join]
+        mask = None if plan.area == 'none' else self._area_mask(countries, plan.area, plan.area_value)
+
+        if plan.family == 'bars':
+            rows = np.arange(len(self.ids)) if mask is None else np.flatnonzero(mask)
+            values = self.metrics['cocoa' if plan.metric == 'cocoa' else 'ratings']
+            chosen = self._top(rows, values, self.ids, plan.order, plan.limit)
+            names = self.country_names + [None]
+            locations, origins = self.joins['sell'][chosen], self.joins['source'][chosen]
+            return [(self.names[row], self.company_names[self.companies[row]], names[location],
+                     self._value(float(self.metrics['ratings'][row])), self._value(float(self.metrics['cocoa'][row])),
+                     names[origin])
+                    for row, location, origin in zip(chosen.tolist(), locations.tolist(), origins.tolist())]
+
+        if plan.family == 'companies':
+            groups, count = self.companies, len(self.company_names)
+            tiebreak = self.company_rank
+        elif plan.family == 'countries':
+            groups, count = countries + 1, len(self.country_names) + 1
+            tiebreak = np.concatenate(([-np.inf], self.country_ids))
+        else:
+            groups, count = self.country_region[countries] + 1, len(self.region_names) + 1
+            tiebreak = np.arange(-1, len(self.region_names))
+        selected = groups if mask is None else groups[mask]
+        bars = np.bincount(selected, minlength=count)
+        if plan.metric == 'number_of_bars':
+            values = bars.astype(np.float64)
+        else:
+            column = self.metrics[plan.metric]
+            if mask is not None:
+                column = column[mask]
+            present = ~np.isnan(column)
+            totals = np.bincount(selected, weights=np.where(present, column, 0.0), minlength=count)
+            counted = np.bincount(selected, weights=present, minlength=count)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = np.where(counted > 0, totals / counted, np.nan)
+        candidates = np.flatnonzero(bars > 4)
+        if plan.metric != 'number_of_bars':
+            # Round like the SQL does, see SORT_DIGITS.
+            settled = self._round([self._value(value) for value in values[candidates].tolist()], SORT_DIGITS)
+            values = np.full(count, np.nan)
+            values[candidates] = np.array(settled, dtype=np.float64)
+        chosen = self._top(candidates, values, tiebreak, plan.order, plan.limit).tolist()
+
+        if plan.metric == 'number_of_bars':
+            shown = [int(bars[group]) for group in chosen]
+        else:
+            shown = self._round([self._value(float(values[group])) for group in chosen],
+                                1 if plan.metric == 'ratings' else 2)
+        if plan.family == 'companies':
+            # min(c.EnglishName): the company's first location by name.
+            ranks = self.country_name_rank[countries if mask is None else countries[mask]]
+            first = np.full(count, len(self.sorted_country_names))
+            np.minimum.at(first, selected[ranks >= 0], ranks[ranks >= 0])
+            names = self.sorted_country_names + [None]
+            return [(self.company_names[group], names[first[group]], value) for group, value in zip(chosen, shown)]
+        if plan.family == 'countries':
+            return [(self.country_names[group - 1] if group else None,
+                     self.region_names[self.country_region[group - 1]] if group else None, value)
+                    for group, value in zip(chosen, shown)]
+        return [(self.region_names[group - 1] if group else None, value) for group, value in zip(chosen, shown)]
+
+_columnar_store = None
+
+def columnar_store():
+    ''' Returns the columnar copy of DBNAME, reloading it when the database changes.'''
+    global _columnar_store
+    with _pool_lock:
+        store = _columnar_store
+        if store is None or store.dbname != DBNAME or (STORAGE == 'disk' and store.watcher.stamp() != store.stamp):
+            if store is not None:
+                store.watcher.close()
+            store = _columnar_store = ColumnarStore(DBNAME)
+    return store
+
+def columnar_fetch(plan):
+    ''' Answers a plan from the columnar store, recording it like a statement.'''
+    start = time.perf_counter()
+    rows = columnar_store().execute(plan)
+    instrumentation.record_statement(f'columnar {plan.family}', time.perf_counter() - start, len(rows))
+    return rows
+
+# Schema of choc.sqlite, for tools that build a database from scratch.
+SCHEMA = [
+    '''create table if not exists Countries (
+        Id INTEGER PRIMARY KEY AUTOINCREMENT,
+        Alpha2 TEXT NOT NULL,
+        Alpha3 TEXT NOT NULL,
+        EnglishName TEXT NOT NULL,
+        Region TEXT NOT NULL,
+        Subregion TEXT NOT NULL,
+        Population INTEGER NOT NULL,
+        Area REAL)''',
+    '''create table if not exists Bars (
+        Id INTEGER PRIMARY KEY AUTOINCREMENT,
+        Company TEXT NOT NULL,
+        SpecificBeanBarName TEXT NOT NULL,
+        REF TEXT NOT NULL,
+        ReviewDate TEXT NOT NULL,
+        CocoaPercent REAL,
+        CompanyLocationId INTEGER,
+        Rating REAL,
+        BeanType TEXT,
+        BroadBeanOriginId INTEGER,
+        FOREIGN KEY(CompanyLocationId) REFERENCES Countries(Id),
+        FOREIGN KEY(BroadBeanOriginId) REFERENCES Countries(Id))''',
+]
+
+def create_schema(connection):
+    ''' Creates the Countries and Bars tables if they do not exist yet.'''
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+# Indexes supporting the joins, filters and sort orders used by Command.
+INDEXES = {
+    'idx_bars_location': 'Bars(CompanyLocationId, Company, Rating, CocoaPercent)',
+    'idx_bars_origin': 'Bars(BroadBeanOriginId, Rating, CocoaPercent)',
+    'idx_bars_company': 'Bars(Company, CompanyLocationId, Rating, CocoaPercent)',
+    'idx_bars_rating': 'Bars(Rating)',
+    'idx_bars_cocoa': 'Bars(CocoaPercent)',
+    'idx_bars_rating_desc': 'Bars(Rating desc, Id)',
+    'idx_bars_cocoa_desc': 'Bars(CocoaPercent desc, Id)',
+    'idx_bars_review': 'Bars(Company, SpecificBeanBarName, REF, ReviewDate)',
+    'idx_countries_alpha2': 'Countries(Alpha2)',
+    'idx_countries_region': 'Countries(Region)',
+}
+
+SAMPLE_AREAS = {'country': 'US', 'region': 'Europe'}
+SAMPLE_TERMS = '"dark"'
+SAMPLE_KEYS = {'page': (), 'page after key': (3.5, 1), 'page after null': (None, 1)}
+
+def connect_writable(dbname=None):
+    ''' Opens a read-write connection for maintenance tasks. Pooled
+    connections are read-only, so anything that changes the schema or
+    data goes through here.
+    '''
+    return sqlite3.connect(dbname or DBNAME)
+
+def ensure_indexes(dbname=None, analyze=True):
+    ''' Creates any missing index from INDEXES and refreshes the planner statistics
+
+    Parameters
+    ----------
+    dbname: string
+        database to optimize, defaults to DBNAME
+    analyze: bool
+        whether to run ANALYZE afterwards
+
+    Returns
+    -------
+    list
+        names of the indexes that were created
+    '''
+    connection = connect_writable(dbname)
+    try:
+        existing = {row[0] for row in connection.execute("select name from sqlite_master where type='index'")}
+        created = []
+        with connection:
+            for name, target in INDEXES.items():
+                if name not in existing:
+                    connection.execute(f'create index {name} on {target}')
+                    created.append(name)
+        if analyze:
+            connection.execute('analyze')
+            connection.commit()
+        return created
+    finally:
+        connection.close()
+
+# Materialized summary tables kept in sync with Bars by triggers.
+# Missing location/origin ids are stored as 0, which matches no country.
+SUMMARY_KEYS = {
+    'CompanySummary': (('Company', '{row}.Company'), ('LocationId', 'ifnull({row}.CompanyLocationId,0)')),
+    'OriginSummary': (('OriginId', 'ifnull({row}.BroadBeanOriginId,0)'),),
+}
+
+def _summary_upsert(table, row, sign):
+    ''' SQL adding (sign '+') or removing (sign '-') one bar in a summary table.'''
+    keys = SUMMARY_KEYS[table]
+    names = ','.join(name for name, _ in keys)
+    values = ','.join(expression.format(row=row) for _, expression in keys)
+    if sign == '+':
+        return f'insert into {table} ({names},RatingSum,RatingCount,CocoaSum,CocoaCount,BarCount) \
+values ({values},ifnull({row}.Rating,0),{row}.Rating is not null,ifnull({row}.CocoaPercent,0),{row}.CocoaPercent is not null,1) \
+on conflict ({names}) do update set RatingSum=RatingSum+excluded.RatingSum,RatingCount=RatingCount+excluded.RatingCount,\
+CocoaSum=CocoaSum+excluded.CocoaSum,CocoaCount=CocoaCount+excluded.CocoaCount,BarCount=BarCount+1;'
+    where = ' and '.join(f'{name}={expression.format(row=row)}' for name, expression in keys)
+    return f'update {table} set RatingSum=RatingSum-ifnull({row}.Rating,0),RatingCount=RatingCount-({row}.Rating is not null),\
+CocoaSum=CocoaSum-ifnull({row}.CocoaPercent,0),CocoaCount=CocoaCount-({row}.CocoaPercent is not null),BarCount=BarCount-1 \
+where {where}; delete from {table} where BarCount=0;'
+
+def summary_schema():
+    ''' Returns the statements creating the summary tables and their triggers.'''
+    statements = []
+    for table, keys in SUMMARY_KEYS.items():
+        columns = ''.join(f'{name} {"TEXT" if name == "Company" else "INTEGER"} NOT NULL,' for name, _ in keys)
+        names = ','.join(name for name, _ in keys)
+        statements.append(f'create table if not exists {table} ({columns}RatingSum REAL NOT NULL,\
+RatingCount INTEGER NOT NULL,CocoaSum REAL NOT NULL,CocoaCount INTEGER NOT NULL,BarCount INTEGER NOT NULL,\
+primary key ({names}))')
+    insert = ' '.join(_summary_upsert(table, 'new', '+') for table in SUMMARY_KEYS)
+    delete = ' '.join(_summary_upsert(table, 'old', '-') for table in SUMMARY_KEYS)
+    statements.append(f'create trigger if not exists BarsSummaryInsert after insert on Bars begin {insert} end')
+    statements.append(f'create trigger if not exists BarsSummaryDelete after delete on Bars begin {delete} end')
+    statements.append(f'create trigger if not exists BarsSummaryUpdate after update of \
+Company,CompanyLocationId,BroadBeanOriginId,Rating,CocoaPercent on Bars begin {delete} {insert} end')
+    return statements
+
+def create_summaries(dbname=None):
+    ''' Creates and fills the summary tables and the triggers that keep them
+    up to date. Rebuilds them from Bars if they already exist.
+
+    Parameters
+    ----------
+    dbname: string
+        database to change, defaults to DBNAME
+
+    Returns
+    -------
+    None
+    '''
+    connection = connect_writable(dbname)
+    try:
+        with connection:
+            for table in SUMMARY_KEYS:
+                connection.execute(f'drop table if exists {table}')
+            for statement in summary_schema():
+                connection.execute(statement)
+            for table, keys in SUMMARY_KEYS.items():
+                names = ','.join(name for name, _ in keys)
+                connection.execute(f'insert into {table} ({names},RatingSum,RatingCount,CocoaSum,CocoaCount,BarCount) \
+{summary_scan(table)}')
+    finally:
+        connection.close()
+
+def drop_summaries(dbname=None):
+    ''' Removes the summary tables and their triggers.'''
+    connection = connect_writable(dbname)
+    try:
+        with connection:
+            for trigger in ('BarsSummaryInsert', 'BarsSummaryDelete', 'BarsSummaryUpdate'):
+                connection.execute(f'drop trigger if exists {trigger}')
+            for table in SUMMARY_KEYS:
+                connection.execute(f'drop table if exists {table}')
+    finally:
+        connection.close()
+
+def summaries_available():
+    ''' Whether the database has the summary tables and triggers. The answer is
+    cached and re-checked when the database changes.
+    '''
+    names = tuple(SUMMARY_KEYS) + ('BarsSummaryInsert', 'BarsSummaryDelete', 'BarsSummaryUpdate')
+    query = f"select count(*) from sqlite_master where name in ({','.join('?' * len(names))})"
+    return cached_fetch_db(query, names)[0][0] == len(names)
+
+# Full-text search over bar names, companies and bean origins. The
+# FTS5 table keeps its own copy of the text, with Bars.Id as rowid, and the
+# triggers keep it in step with Bars and with renamed countries.
+SEARCH_TRIGGERS = ('BarsSearchInsert', 'BarsSearchDelete', 'BarsSearchUpdate', 'CountriesSearchUpdate')
+SEARCH_OBJECTS = ('BarsSearch',) + SEARCH_TRIGGERS
+SEARCH_OBJECTS_QUERY = f"select count(*) from sqlite_master where name in ({','.join('?' * len(SEARCH_OBJECTS))})"
+
+def search_schema():
+    ''' Returns the statements creating the search table and its triggers.'''
+    insert = "insert into BarsSearch (rowid,Name,Company,Origin) values (new.Id,new.SpecificBeanBarName,\
+new.Company,(select EnglishName from Countries where Id=new.BroadBeanOriginId));"
+    delete = 'delete from BarsSearch where rowid=old.Id;'
+    return [
+        "create virtual table if not exists BarsSearch using fts5(Name,Company,Origin,\
+tokenize='unicode61 remove_diacritics 2')",
+        f'create trigger if not exists BarsSearchInsert after insert on Bars begin {insert} end',
+        f'create trigger if not exists BarsSearchDelete after delete on Bars begin {delete} end',
+        f'create trigger if not exists BarsSearchUpdate after update of \
+Id,SpecificBeanBarName,Company,BroadBeanOriginId on Bars begin {delete} {insert} end',
+        'create trigger if not exists CountriesSearchUpdate after update of EnglishName on Countries begin \
+update BarsSearch set Origin=new.EnglishName where rowid in (select Id from Bars where BroadBeanOriginId=new.Id); end',
+    ]
+
+def create_search_index(dbname=None):
+    ''' Creates and fills the full-text search table and the triggers that
+    keep it up to date. Rebuilds it if it already exists.
+
+    Parameters
+    ----------
+    dbname: string
+        database to change, defaults to DBNAME
+
+    Returns
+    -------
+    None
+    '''
+    connection = connect_writable(dbname)
+    try:
+        with connection:
+            connection.execute('drop table if exists BarsSearch')
+            for statement in search_schema():
+                connection.execute(statement)
+            connection.execute('insert into BarsSearch (rowid,Name,Company,Origin) \
+select b.Id,b.SpecificBeanBarName,b.Company,o.EnglishName from Bars b left join Countries o on b.BroadBeanOriginId=o.Id')
+            connection.execute("insert into BarsSearch (BarsSearch) values ('optimize')")
+    finally:
+        connection.close()
+
+def drop_search_index(dbname=None):
+    ''' Removes the full-text search table and its triggers.'''
+    connection = connect_writable(dbname)
+    try:
+        with connection:
+            for trigger in SEARCH_TRIGGERS:
+                connection.execute(f'drop trigger if exists {trigger}')
+            connection.execute('drop table if exists BarsSearch')
+    finally:
+        connection.close()
+
+def search_available():
+    ''' Whether the database has the search table and its triggers, cached
+    like summaries_available.
+    '''
+    return cached_fetch_db(SEARCH_OBJECTS_QUERY, SEARCH_OBJECTS)[0][0] == len(SEARCH_OBJECTS)
+
+# Bulk loading from the raw ratings CSV and a countries CSV. Headers
+# are matched ignoring case, spaces and punctuation, so both the cleaned
+# course files and the original Kaggle export are accepted.
+LOAD_CHUNK_SIZE = 10000
+LOAD_COMMIT_ROWS = 500000
+BARS_CSV_COLUMNS = {
+    'Company': ('company', 'companymakerifknown'),
+    'SpecificBeanBarName': ('specificbeanbarname', 'specificbeanoriginorbarname'),
+    'REF': ('ref',),
+    'ReviewDate': ('reviewdate',),
+    'CocoaPercent': ('cocoapercent',),
+    'CompanyLocation': ('companylocation',),
+    'Rating': ('rating',),
+    'BeanType': ('beantype',),
+    'BroadBeanOrigin': ('broadbeanorigin',),
+}
+COUNTRIES_CSV_COLUMNS = {
+    'Alpha2': ('alpha2', 'alpha2code'),
+    'Alpha3': ('alpha3', 'alpha3code'),
+    'EnglishName': ('englishname', 'name'),
+    'Region': ('region',),
+    'Subregion': ('subregion',),
+    'Population': ('population',),
+    'Area': ('area',),
+}
+
+def _csv_columns(header, columns, path):
+    ''' Maps every wanted column to its position in a CSV header.'''
+    positions = {re.sub(r'[^a-z0-9]', '', name.lower()): index for index, name in enumerate(header)}
+    found = {}
+    for column, aliases in columns.items():
+        for alias in aliases:
+            if alias in positions:
+                found[column] = positions[alias]
+                break
+    missing = [column for column in columns if column not in found]
+    if missing:
+        raise ValueError(f"{path}: missing column{'s' if len(missing) > 1 else ''} {', '.join(missing)}")
+    return found
+
+def _text(value):
+    value = value.strip()
+    return value or None
+
+def _number(value):
+    value = value.strip()
+    return float(value) if value else None
+
+def parse_cocoa_percent(value):
+    ''' Turns a cocoa percentage such as '70%' or '72.5' into the fraction
+    stored in Bars (0.7, 0.725). Fractions are kept as they are and an empty
+    value becomes None.
+    '''
+    value = value.strip()
+    if not value:
+        return None
+    percent = float(value.rstrip('%'))
+    return percent / 100 if value.endswith('%') or percent > 1 else percent
+
+def _read_csv(path, columns):
+    ''' Yields dicts of the wanted columns from a CSV file, one row at a time.'''
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        positions = _csv_columns(next(reader, []), columns, path)
+        for row in reader:
+            if row:
+                yield {column: row[index] for column, index in positions.items()}
+
+def _load_countries(connection, path):
+    known = {row[0] for row in connection.execute('select Alpha2 from Countries')}
+    rows = []
+    for row in _read_csv(path, COUNTRIES_CSV_COLUMNS):
+        alpha2 = row['Alpha2'].strip()
+        if alpha2 in known:
+            continue
+        known.add(alpha2)
+        population = _number(row['Population'])
+        rows.append((alpha2, row['Alpha3'].strip(), row['EnglishName'].strip(), row['Region'].strip(),
+                     row['Subregion'].strip(), int(population or 0), _number(row['Area'])))
+    connection.executemany('insert into Countries (Alpha2,Alpha3,EnglishName,Region,Subregion,Population,Area) \
+values (?,?,?,?,?,?,?)', rows)
+    return len(rows)
+
+def load_csv(bars_path, countries_path=None, dbname=None, append=False, chunk_size=LOAD_CHUNK_SIZE):
+    ''' Builds or extends the database from CSV files
+
+    Rows are streamed and inserted in chunks, so memory use does not grow
+    with the file. A full load empties Bars (and Countries when a countries
+    file is given), drops the indexes and summary tables and rebuilds them
+    afterwards. An append keeps everything and skips reviews already loaded,
+    recognized by company, bar name, REF and review date together; REF alone
+    is shared by every review entered in the same batch.
+
+    Parameters
+    ----------
+    bars_path: string
+        ratings CSV, one bar per row
+    countries_path: string
+        countries CSV, or None to use the countries already in the database
+    dbname: string
+        database to write, defaults to DBNAME; created if missing
+    append: bool
+        whether to add new reviews instead of replacing all bars
+    chunk_size: int
+        rows per executemany call
+
+    Returns
+    -------
+    dict
+        numbers of bars and countries inserted, bars skipped as already
+        loaded and bars with a location or origin not found in Countries
+    '''
+    dbname = dbname or DBNAME
+    connection = connect_writable(dbname)
+    try:
+        connection.execute('pragma synchronous=off')
+        create_schema(connection)
+        existing = {row[0] for row in connection.execute('select name from sqlite_master')}
+        rebuild_summaries = all(table in existing for table in SUMMARY_KEYS)
+        rebuild_search = 'BarsSearch' in existing
+        insert = 'insert into Bars (Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,CompanyLocationId,\
+Rating,BeanType,BroadBeanOriginId) '
+        if append:
+            connection.execute(f"create index if not exists idx_bars_review on {INDEXES['idx_bars_review']}")
+            insert += 'select ?1,?2,?3,?4,?5,?6,?7,?8,?9 where not exists (select 1 from Bars where Company=?1 \
+and SpecificBeanBarName=?2 and REF=?3 and ReviewDate=?4)'
+        else:
+            insert += 'values (?,?,?,?,?,?,?,?,?)'
+            with connection:
+                for trigger in ('BarsSummaryInsert', 'BarsSummaryDelete', 'BarsSummaryUpdate'):
+                    connection.execute(f'drop trigger if exists {trigger}')
+                for table in SUMMARY_KEYS:
+                    connection.execute(f'drop table if exists {table}')
+                for trigger in SEARCH_TRIGGERS:
+                    connection.execute(f'drop trigger if exists {trigger}')
+                connection.execute('drop table if exists BarsSearch')
+                for name in INDEXES:
+                    connection.execute(f'drop index if exists {name}')
+                tables = ('Bars', 'Countries') if countries_path else ('Bars',)
+                for table in tables:
+                    connection.execute(f'delete from {table}')
+                if 'sqlite_sequence' in existing:
+                    connection.execute(f"delete from sqlite_sequence where name in ({','.join('?' * len(tables))})",
+                                       tables)
+        stats = {'bars': 0, 'countries': 0, 'skipped': 0, 'unmatched': 0}
+        if countries_path:
+            with connection:
+                stats['countries'] = _load_countries(connection, countries_path)
+        countries = {}
+        for country_id, name in connection.execute('select Id,EnglishName from Countries order by Id'):
+            countries.setdefault(name, country_id)
+            countries.setdefault(name.casefold(), country_id)
+
+        def lookup(name):
+            name = name.strip()
+            return countries.get(name, countries.get(name.casefold())) if name else None
+
+        def bars():
+            for row in _read_csv(bars_path, BARS_CSV_COLUMNS):
+                location, origin = lookup(row['CompanyLocation']), lookup(row['BroadBeanOrigin'])
+                if (location is None and _text(row['CompanyLocation'])) or (origin is None and _text(row['BroadBeanOrigin'])):
+                    stats['unmatched'] += 1
+                yield (row['Company'].strip(), row['SpecificBeanBarName'].strip(), row['REF'].strip(),
+                       row['ReviewDate'].strip(),
+                       parse_cocoa_percent(row['CocoaPercent']), location, _number(row['Rating']),
+                       _text(row['BeanType']), origin)
+
+        rows = bars()
+        pending = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            inserted = connection.executemany(insert, chunk).rowcount
+            stats['bars'] += inserted
+            stats['skipped'] += len(chunk) - inserted
+            pending += inserted
+            if pending >= LOAD_COMMIT_ROWS:
+                connection.commit()
+                pending = 0
+        connection.commit()
+    finally:
+        connection.close()
+    ensure_indexes(dbname)
+    if rebuild_summaries and not append:
+        create_summaries(dbname)
+    if rebuild_search and not append:
+        create_search_index(dbname)
+    return stats
+
+def iter_query_templates(summary=True, search=True):
+    ''' Yields every query shape Command and the pager can run, together
+    with its SQL and sample parameters. A shape is (family, metric, source,
+    area, order, variant); the variant is 'query', or 'page', 'page after
+    key' or 'page after null' for the pager's keyset queries, prefixed with
+    'summary ' when the aggregate is read from the summary tables.
+
+    Parameters
+    ----------
+    summary: bool
+        include the shapes reading the summary tables
+    search: bool
+        include the search family, which needs the full-text index
+    '''
+    shapes = {
+        'bars': (('ratings', 'cocoa'), ('sell', 'source'), ('none', 'country', 'region')),
+        'companies': (tuple(METRICS), ('sell',), ('none', 'country', 'region')),
+        'countries': (tuple(METRICS), ('sell', 'source'), ('none', 'region')),
+        'regions': (tuple(METRICS), ('sell', 'source'), ('none',)),
+        'search': (('rank', 'ratings', 'cocoa'), ('sell', 'source'), ('none', 'country', 'region')),
+    }
+    if not search:
+        del shapes['search']
+    for family, (metrics, sources, areas) in shapes.items():
+        summaries = (False, True) if summary and family in GROUPS else (False,)
+        for metric, source, area, order, stored in itertools.product(metrics, sources, areas, ORDERS, summaries):
+            leading = ([SAMPLE_TERMS] if family == 'search' else []) + ([SAMPLE_AREAS[area]] if area != 'none' else [])
+            prefix = 'summary ' if stored else ''
+            sql = query_template(family, metric, source, area, order, stored)
+            yield (family, metric, source, area, order, prefix + 'query'), sql, tuple(leading + [10])
+            for variant, key in SAMPLE_KEYS.items():
+                keyset = tuple(value is None for value in key)
+                sql = query_template(family, metric, source, area, order, stored, keyset)
+                parameters = keyset_parameters((sort_direction(metric, order), 'asc'), key,
+                                               bounded=family == 'bars') if key else []
+                yield (family, metric, source, area, order, prefix + variant), sql, tuple(leading + parameters + [11])
+
+def check_query_plans(dbname=None):
+    ''' Runs EXPLAIN QUERY PLAN on every query template and reports full table scans
+
+    The summary tables hold one row per group and may be scanned; the summary
+    and search shapes are only checked when the database has those tables.
+
+    Parameters
+    ----------
+    dbname: string
+        database to check, defaults to DBNAME
+
+    Returns
+    -------
+    list
+        (shape, plan detail) for every step that scans a table without an index
+    '''
+    connection = connect_writable(dbname)
+    problems = []
+    try:
+        names = {row[0] for row in connection.execute('select name from sqlite_master')}
+        templates = iter_query_templates(summary=set(SUMMARY_KEYS) <= names, search='BarsSearch' in names)
+        for shape, sql, parameters in templates:
+            for row in connection.execute('explain query plan ' + sql, parameters):
+                detail = row[-1]
+                if re.fullmatch(r'SCAN \w+', detail) and not (shape[-1].startswith('summary') and detail == 'SCAN s'):
+                    problems.append((shape, detail))
+    finally:
+        connection.close()
+    return problems
+
 def load_help_text():
     with open('Proj3Help.txt') as f:
         return f.read()
 
 # Part 2 & 3: Implement interactive prompt and plotting. We've started for you!
+NOT_RECOGNIZED = 'Command not recognized. You can enter \'help\' to view valid options.'
+
+NO_PAGES = 'There is no command to page through. Run a command first.'
+
 def interactive_prompt():
     help_text = load_help_text()
-    response = ''
-    commands_list =['bars','countries','companies','regions','']
-    bars_list = ['none','sell','source','ratings','cocoa','top','bottom','barplot']
-    companies_list = ['none','number_of_bars','ratings','cocoa','top','bottom','barplot']
-    countries_list = ['none','sell','source','number_of_bars','ratings','cocoa','top','bottom','barplot']
-    regions_list= ['sell','source','number_of_bars','ratings','cocoa','top','bottom','barplot']
-
-    while response != 'exit':
+    pager = None
+    while True:
         response = input('Enter a command: ').lower()
-        words = response.split(' ')
         if response == 'help':
             print(help_text)
-            continue
+        elif response == 'stats':
+            print(format_stats())
+        elif response == 'summary':
+            print(format_summary())
         elif response == 'exit':
             print('Bye')
+            close_pool()
             exit()
+        elif response in ('next', 'prev'):
+            if pager is None:
+                print(NO_PAGES)
+                continue
+            rows = pager.next() if response == 'next' else pager.prev()
+            if rows is None:
+                print('No more rows.' if response == 'next' else 'Already on the first page.')
+                continue
+            with instrumentation.stage('format'):
+                write_rows(pager.plan, rows)
         else:
-            if words[0] not in commands_list[:5] or (words[0] == commands_list[4] and len(words)!=1):
-                print('Command not recognized. You can enter \'help\' to view valid options.')
+            try:
+                with instrumentation.stage('parse'):
+                    plan = parse_command(response)
+            except CommandError:
+                print(NOT_RECOGNIZED)
                 continue
-            elif words[0] == commands_list[4] and len(words)==1:
-                print((print_query_result('bars')))
-            else:      
-                if words[0] !='regions':
-                    if 'country' in response or 'region' in response:
-                        areas_index = [key for key,val in enumerate(words) if 'region' in val or 'country' in val]
-                        words.remove(words[areas_index[0]])
-
-                bars_validity = False
-                companies_validity= False
-                countries_validity= False
-                regions_validity = False
-
-                if words[0] == 'bars':
-                    bars_validity = all(word in bars_list for word in words[1:] if word.isnumeric()==False)
-                elif words[0] =='companies':
-                    companies_validity = all(word in companies_list for word in words[1:] if word.isnumeric()==False) 
-                elif words[0] =='regions':
-                    regions_validity = all(word in regions_list for word in words[1:] if word.isnumeric()==False) 
-                else:
-                    countries_validity = all(word in countries_list for word in words[1:] if word.isnumeric()==False) 
-                
-                if words[0] !='regions':
-                    if 'country' in response or 'region' in response:
-                        result = response.split(' ')
-                        areas_index = [key for key,val in enumerate(result) if 'region' in val or 'country' in val]
-                        areas_validity = re.match('country=[a-z][a-z]|region=[a-z]+',result[areas_index[0]])
-
-                        if areas_validity:
-                            if bars_validity is True or companies_validity is True or countries_validity is True or regions_validity is True:
-                                print(print_query_result(response))
-                                continue
-                            else:
-                                print('Command not recognized. You can enter \'help\' to view valid options.')
-                                continue
-                        else:
-                            print('Command not recognized. You can enter \'help\' to view valid options.')
-                            continue
-                    else:
-                        if bars_validity is True or companies_validity is True or countries_validity is True or regions_validity is True:
-                            print(print_query_result(response))
-                            continue
-                        else:
-                            print('Command not recognized. You can enter \'help\' to view valid options.')
-                            continue
-                else:
-                    if bars_validity is True or companies_validity is True or countries_validity is True or regions_validity is True:
-                        print(print_query_result(response))
-                        continue  
-                    else:
-                        print('Command not recognized. You can enter \'help\' to view valid options.')
-                        continue
+            pager = Pager(plan)
+            try:
+                with instrumentation.stage('format'):
+                    rows = pager.first()
+                    if plan.barplot:
+                        rows = list(rows)
+                    write_rows(plan, rows)
+            except SearchUnavailable as error:
+                pager = None
+                print(error)
+                continue
+            if plan.barplot:
+                plot_plan(plan, rows)
+
+# Batch mode: run many commands on a pool of workers. Each worker streams a
+# result into a spool file, kept in memory up to BATCH_SPOOL_SIZE bytes, and
+# the results are copied to the output in input order. In csv and ndjson,
+# every row starts with the command it answers (the view, for summary) and
+# a csv result starts with its own header row, as commands have different
+# columns. With an output directory, each result goes to its own file.
+BATCH_WINDOW = 4
+BATCH_SPOOL_SIZE = 1 << 20
+PROCESS_CHUNK_SIZE = 32
+
+def run_batch_command(command, out, err=None):
+    ''' Validates and runs one batch command the same way the prompt does
+
+    Parameters
+    ----------
+    command: string
+        one line of a batch file
+    out: file
+        where to write the result in OUTPUT_FORMAT. With OUTPUT_DIR set or
+        a binary format, the result goes to a file in OUTPUT_DIR instead and
+        only the number of rows written is reported.
+    err: file
+        where to write the prompt's error messages, defaults to out
+
+    Returns
+    -------
+    None
+    '''
+    err = err or out
+    command = command.strip().lower()
+    if command == 'summary':
+        if OUTPUT_DIR is None or OUTPUT_FORMAT not in ('csv', 'ndjson'):
+            out.write(format_summary() + '\n')
+            return
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        path = os.path.join(OUTPUT_DIR, 'summary.' + OUTPUT_FORMAT)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            f.write(format_summary() + '\n')
+        out.write(f'summary written to {path}\n')
+        return
+    try:
+        plan = parse_command(command)
+    except CommandError:
+        err.write(NOT_RECOGNIZED + '\n')
+        return
+    try:
+        if OUTPUT_FORMAT == 'table':
+            write_query_result(plan, out)
+        elif OUTPUT_FORMAT in TEXT_FORMATS and OUTPUT_DIR is None:
+            rows = process_command(plan) if plan.barplot else stream_plan(plan)
+            write_rows(RowLayout(('Command',) + plan.columns, None), ((command,) + tuple(row) for row in rows), out)
+        else:
+            directory = OUTPUT_DIR or '.'
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, export_filename(plan, OUTPUT_FORMAT))
+            if OUTPUT_FORMAT in TEXT_FORMATS:
+                with open(path, 'w', newline='', encoding='utf-8') as f:
+                    count = write_query_result(plan, f)
+            else:
+                count = export_query_result(plan, path, OUTPUT_FORMAT)
+            out.write(f'{count} rows written to {path}\n')
+    except SearchUnavailable as error:
+        err.write(str(error) + '\n')
+
+def _run_batch_chunk(commands, processes=False):
+    # Returns (spool, error messages) for every command. Worker processes
+    # write to named files and return their paths.
+    results = []
+    try:
+        for command in commands:
+            if processes:
+                spool = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.choc', delete=False)
+            else:
+                spool = tempfile.SpooledTemporaryFile(BATCH_SPOOL_SIZE, 'w+', encoding='utf-8', newline='')
+            errors = io.StringIO()
+            results.append((spool.name if processes else spool, errors))
+            run_batch_command(command, spool, errors)
+            if processes:
+                spool.close()
+    except BaseException:
+        for spool, _ in results:
+            _discard_spool(spool)
+        raise
+    if processes and _plot_renderer is not None:
+        _plot_renderer.wait()
+    return [(spool, errors.getvalue()) for spool, errors in results]
+
+def _discard_spool(spool):
+    if isinstance(spool, str):
+        os.unlink(spool)
     else:
-        print('Bye')
-        exit()
+        spool.close()
 
-# Make sure nothing runs or prints out when this file is run as a module/library
-if __name__=="__main__":
+def _copy_batch_result(result, out, err):
+    spool, errors = result
+    try:
+        if isinstance(spool, str):
+            with open(spool, encoding='utf-8', newline='') as f:
+                shutil.copyfileobj(f, out)
+        else:
+            spool.seek(0)
+            shutil.copyfileobj(spool, out)
+    finally:
+        _discard_spool(spool)
+    if errors:
+        out.flush()
+        err.write(errors)
+
+def _init_batch_process(dbname, backend='sqlite', storage='disk', plot_dir=None, plot_format='html', shards=None,
+                        output_format='table', output_dir=None):
+    # Connections must not cross a fork, so each worker process opens its own.
+    global DBNAME, BACKEND, STORAGE, SHARDS, _pool, _result_cache, _columnar_store, _plot_renderer, _shard_set
+    DBNAME = dbname
+    SHARDS = shards
+    _shard_set = None
+    BACKEND = backend
+    STORAGE = storage
+    _pool = None
+    _result_cache = None
+    _columnar_store = None
+    _plot_renderer = None
+    set_plot_export(plot_dir, plot_format)
+    set_output(output_format, output_dir)
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def run_batch(lines, out=None, err=None, workers=None, processes=False):
+    ''' Runs commands on a thread or process pool and writes their results
+    to out in input order. Blank lines and lines starting with '#' are skipped.
+
+    Parameters
+    ----------
+    lines: iterable
+        command strings, e.g. an open file
+    out: file
+        where to write the results, defaults to sys.stdout
+    err: file
+        where to write error messages; defaults to out for tables and to
+        sys.stderr otherwise, so that csv and ndjson output stays parseable
+    workers: int
+        number of worker threads/processes, defaults to the number of CPUs
+    processes: bool
+        use worker processes instead of threads
+
+    Returns
+    -------
+    int
+        the number of commands run; barplot commands also draw their plot,
+        see plot_plan
+    '''
+    out = out or sys.stdout
+    err = err or (out if OUTPUT_FORMAT == 'table' else sys.stderr)
+    count = 0
+    workers = workers or os.cpu_count() or 1
+    commands = (line.strip() for line in lines)
+    commands = (command for command in commands if command and not command.startswith('#'))
+    if processes:
+        chunks = _chunks(commands, PROCESS_CHUNK_SIZE)
+        initargs = (DBNAME, BACKEND, STORAGE, PLOT_EXPORT_DIR, PLOT_EXPORT_FORMAT, SHARDS, OUTPUT_FORMAT, OUTPUT_DIR)
+        executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_batch_process, initargs=initargs)
+    else:
+        chunks = _chunks(commands, 1)
+        configure_pool(workers)
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+    with executor:
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(_run_batch_chunk, chunk, processes))
+                while len(pending) >= workers * BATCH_WINDOW or (pending and pending[0].done()):
+                    for result in pending.popleft().result():
+                        _copy_batch_result(result, out, err)
+                        count += 1
+            while pending:
+                for result in pending.popleft().result():
+                    _copy_batch_result(result, out, err)
+                    count += 1
+        finally:
+            for future in pending:
+                if not future.cancel() and future.exception() is None:
+                    for spool, _ in future.result():
+                        _discard_spool(spool)
+    if _plot_renderer is not None:
+        _plot_renderer.wait()
+    return count
+
+# Daemon mode: a long lived process that keeps the interpreter, connection
+# pool and result cache warm, and a thin client that talks to it over a
+# Unix socket. The client sends one command line; the daemon streams the
+# formatted result back and closes the connection.
+DAEMON_SOCKET = os.path.join(tempfile.gettempdir(), f'choc-{os.getuid() if hasattr(os, "getuid") else 0}.sock')
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        response = self.rfile.readline().decode('utf-8').strip().lower()
+        out = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+        try:
+            if response == 'help':
+                out.write(load_help_text() + '\n')
+            elif response == 'stats':
+                out.write(format_stats() + '\n')
+            elif response == 'summary':
+                out.write(format_summary() + '\n')
+            else:
+                try:
+                    plan = parse_command(response)
+                except CommandError:
+                    out.write(NOT_RECOGNIZED + '\n')
+                else:
+                    try:
+                        write_query_result(plan, out)
+                    except SearchUnavailable as error:
+                        out.write(str(error) + '\n')
+        finally:
+            out.detach()
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(socket_path=DAEMON_SOCKET):
+    ''' Runs the daemon until it is interrupted or sent SIGTERM
+
+    Parameters
+    ----------
+    socket_path: string
+        path of the Unix socket to listen on
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    RuntimeError
+        if another daemon is already listening on socket_path
+    '''
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError(f'a daemon is already listening on {socket_path}')
+    server = DaemonServer(socket_path, DaemonHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        close_pool()
+
+def run_client(command, socket_path=DAEMON_SOCKET, out=None):
+    ''' Sends a command to a running daemon and copies its answer to out
+
+    Parameters
+    ----------
+    command: string
+        The command string represents a query that the user want to run
+    socket_path: string
+        path of the daemon's Unix socket
+    out: file
+        binary file object for the answer, defaults to sys.stdout's buffer
+
+    Returns
+    -------
+    None
+    '''
+    out = out or sys.stdout.buffer
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(command.encode('utf-8') + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            out.write(data)
+    out.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the chocolate bar database.')
+    parser.add_argument('--optimize-db', action='store_true',
+                        help='create the supporting indexes and run ANALYZE, then exit')
+    parser.add_argument('--check-plans', action='store_true',
+                        help='report query templates whose plan scans a whole table, then exit')
+    parser.add_argument('--build-summaries', action='store_true',
+                        help='create the materialized aggregate tables and their triggers, then exit')
+    parser.add_argument('--drop-summaries', action='store_true',
+                        help='remove the materialized aggregate tables, then exit')
+    parser.add_argument('--build-search', action='store_true',
+                        help='create the full-text index used by the search command (on every --shard, if '
+                             'given), then exit')
+    parser.add_argument('--drop-search', action='store_true',
+                        help='remove the full-text index (from every --shard, if given), then exit')
+    parser.add_argument('--load', metavar='CSV',
+                        help='fill the database from a ratings CSV (building indexes afterwards), then exit')
+    parser.add_argument('--countries', metavar='CSV', help='countries CSV to load along with --load')
+    parser.add_argument('--append', action='store_true',
+                        help='with --load, add the reviews not already loaded instead of replacing them')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="run the commands in FILE ('-' for stdin) and print the results")
+    parser.add_argument('--workers', type=int, help='number of batch workers')
+    parser.add_argument('--processes', action='store_true',
+                        help='run batch commands in worker processes instead of threads')
+    parser.add_argument('--daemon', action='store_true',
+                        help='serve commands on a Unix socket, keeping connections and caches warm')
+    parser.add_argument('--client', metavar='COMMAND',
+                        help='send COMMAND to a running daemon and print the result')
+    parser.add_argument('--socket', default=DAEMON_SOCKET, help='Unix socket of the daemon')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND,
+                        help='answer commands with SQLite or with in-memory NumPy column arrays')
+    parser.add_argument('--plot-dir', metavar='DIR',
+                        help='write the plots of barplot commands to DIR instead of opening a browser')
+    parser.add_argument('--plot-format', choices=PLOT_FORMATS, default='html',
+                        help='file format for --plot-dir: an HTML page or the plotly figure JSON')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT,
+                        help='how to write results: a table, CSV or NDJSON; npy and arrow files with --batch. '
+                             'In batch CSV and NDJSON, rows start with their command and errors go to stderr')
+    parser.add_argument('--output-dir', metavar='DIR',
+                        help='write every --batch result in CSV, NDJSON, npy or arrow to its own file in this '
+                             'directory; npy and arrow default to the current one')
+    parser.add_argument('--shard', metavar='DB', action='append',
+                        help='query these databases together instead of choc.sqlite; repeat for every shard')
+    parser.add_argument('--storage', choices=STORAGE_MODES, default=STORAGE,
+                        help="how to open the database: 'memory' and 'immutable' treat it as a read-only snapshot")
+    parser.add_argument('--instrument', action='store_true',
+                        help="record stage and SQL timings, shown by the 'stats' command")
+    parser.add_argument('--stats-file', default=os.environ.get('CHOC_STATS_FILE'),
+                        help='write the recorded timings to this file on exit (.prom/.txt: Prometheus text, else JSON)')
+    args = parser.parse_args(argv)
+
+    set_backend(args.backend)
+    set_storage(args.storage)
+    set_plot_export(args.plot_dir, args.plot_format)
+    set_output(args.format, args.output_dir)
+    if args.shard:
+        set_shards(args.shard)
+    if args.instrument or args.stats_file:
+        enable_instrumentation()
+    if args.stats_file:
+        atexit.register(dump_stats, args.stats_file)
+
+    if args.client is not None:
+        run_client(args.client, args.socket)
+        return 0
+
+    if args.load:
+        stats = load_csv(args.load, args.countries, append=args.append)
+        print(f"Loaded {stats['bars']} bars and {stats['countries']} countries "
+              f"({stats['skipped']} already loaded, {stats['unmatched']} with an unknown country)")
+        return 0
+    if args.drop_summaries:
+        drop_summaries()
+    if args.build_summaries:
+        create_summaries()
+    for dbname in args.shard or [None]:
+        if args.drop_search:
+            drop_search_index(dbname)
+        if args.build_search:
+            create_search_index(dbname)
+
+    if args.optimize_db:
+        created = ensure_indexes()
+        print('Created indexes: ' + (', '.join(created) if created else 'none'))
+    if args.check_plans:
+        problems = check_query_plans()
+        for shape, detail in problems:
+            print(' '.join(shape) + ': ' + detail)
+        print(f'{len(problems)} full table scans found')
+        return 1 if problems else 0
+    if args.batch:
+        lines = sys.stdin if args.batch == '-' else open(args.batch)
+        with lines:
+            run_batch(lines, workers=args.workers, processes=args.processes)
+        return 0
+    if args.daemon:
+        try:
+            serve(args.socket)
+        except RuntimeError as error:
+            print(error, file=sys.stderr)
+            return 1
+        return 0
+    if args.optimize_db or args.build_summaries or args.drop_summaries or args.build_search or args.drop_search:
+        return 0
     interactive_prompt()
 
+if __name__=="__main__":
+    sys.exit(main())
+
@@ -0,0 +1,158 @@
+'''Writes synthetic choc.sqlite-compatible databases for benchmarking.
+
+    python synth_choc.py OUTPUT [--bars N] [--companies N] [--countries N]
+                                [--seed N] [--optimize] [--split-by region|year]
+
+Companies, company locations and bean origins follow Zipf-like
+distributions, so a few makers and origins account for most bars, like
+in the real ratings data. Ratings cluster around 3.25 in steps of 0.25
+and cocoa percentages around 70%. Some makers sell from a second
+location, and a few bars have no rating, cocoa percentage, location or
+origin, like rows the CSV loader could not match.
+'''
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import string
+import sys
+
+import proj3_choc
+
+REGIONS = ['Americas', 'Europe', 'Africa', 'Asia', 'Oceania']
+BEAN_TYPES = ['Criollo', 'Trinitario', 'Forastero', 'Blend', '']
+CHUNK_SIZE = 50000
+SECOND_LOCATION = 0.2
+MISSING = 0.03
+
+def zipf_weights(count, exponent=1.1):
+    ''' Returns cumulative weights of a Zipf distribution over count items.'''
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+def make_countries(count, rng):
+    ''' Returns Countries rows with unique two letter codes.'''
+    codes = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+    if count > len(codes):
+        raise ValueError(f'at most {len(codes)} countries are supported')
+    rng.shuffle(codes)
+    rows = []
+    for index, code in enumerate(codes[:count]):
+        region = REGIONS[index % len(REGIONS)]
+        rows.append((code, code + 'X', f'Country {code}', region, f'{region} {index % 3}',
+                     rng.randint(10 ** 5, 10 ** 9), float(rng.randint(10 ** 3, 10 ** 7))))
+    return rows
+
+def make_bars(count, companies, countries, rng):
+    ''' Yields Bars rows. Each company has one location, a SECOND_LOCATION
+    share of them a second one, and both companies and bean origins are
+    drawn with a Zipf skew. A MISSING share of ratings, cocoa percentages,
+    locations and origins is NULL.
+    '''
+    company_weights = zipf_weights(companies)
+    country_weights = zipf_weights(countries)
+    locations = rng.choices(range(1, countries + 1), cum_weights=country_weights, k=companies)
+    seconds = [rng.randint(1, countries) if rng.random() < SECOND_LOCATION else None for _ in range(companies)]
+
+    def missing(value):
+        return None if rng.random() < MISSING else value
+    for start in range(0, count, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, count - start)
+        makers = rng.choices(range(companies), cum_weights=company_weights, k=size)
+        origins = rng.choices(range(1, countries + 1), cum_weights=country_weights, k=size)
+        for offset, (maker, origin) in enumerate(zip(makers, origins)):
+            number = start + offset
+            rating = min(5.0, max(1.0, round(rng.gauss(3.2, 0.45) * 4) / 4))
+            cocoa = min(1.0, max(0.42, round(rng.gauss(0.71, 0.06), 2)))
+            location = seconds[maker] if seconds[maker] and rng.random() < 0.3 else locations[maker]
+            yield (f'Maker {maker}', f'Bar {number}', str(number), str(2006 + number % 12), missing(cocoa),
+                   missing(location), missing(rating), rng.choice(BEAN_TYPES), missing(origin))
+
+def generate(path, bars=2000, companies=400, countries=100, seed=0):
+    ''' Writes a new database at path, replacing any existing file.'''
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('pragma journal_mode=off')
+        connection.execute('pragma synchronous=off')
+        with connection:
+            proj3_choc.create_schema(connection)
+            connection.executemany('insert into Countries (Alpha2,Alpha3,EnglishName,Region,Subregion,Population,Area) \
+values (?,?,?,?,?,?,?)', make_countries(countries, rng))
+            rows = make_bars(bars, companies, countries, rng)
+            while True:
+                chunk = list(itertools.islice(rows, CHUNK_SIZE))
+                if not chunk:
+                    break
+                connection.executemany('insert into Bars (Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,\
+CompanyLocationId,Rating,BeanType,BroadBeanOriginId) values (?,?,?,?,?,?,?,?,?)', chunk)
+    finally:
+        connection.close()
+
+# split key -> SQL expression over Bars b left joined to its company location c
+SPLIT_KEYS = {
+    'region': "ifnull(c.Region,'none')",
+    'year': 'b.ReviewDate',
+}
+
+def split(path, by='region'):
+    ''' Splits the bars of a database into shard files next to it, one per
+    company region or review year, each with a full copy of Countries.
+    Bar ids are kept, so the shards can be queried together.
+
+    Returns
+    -------
+    list
+        paths of the shard files
+    '''
+    key = SPLIT_KEYS[by]
+    stem = os.path.splitext(path)[0]
+    source = sqlite3.connect(path)
+    try:
+        values = [row[0] for row in source.execute(f'select distinct {key} from Bars b \
+left join Countries c on b.CompanyLocationId=c.Id order by 1')]
+    finally:
+        source.close()
+    shards = []
+    for value in values:
+        shard = f"{stem}.{''.join(ch if ch.isalnum() else '_' for ch in str(value))}.sqlite"
+        if os.path.exists(shard):
+            os.remove(shard)
+        connection = sqlite3.connect(shard)
+        try:
+            connection.execute('pragma journal_mode=off')
+            connection.execute('attach database ? as source', (path,))
+            with connection:
+                proj3_choc.create_schema(connection)
+                connection.execute('insert into Countries select * from source.Countries')
+                connection.execute(f'insert into Bars select b.* from source.Bars b \
+left join source.Countries c on b.CompanyLocationId=c.Id where {key}=? order by b.Id', (value,))
+        finally:
+            connection.close()
+        shards.append(shard)
+    return shards
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic chocolate bar database.')
+    parser.add_argument('output')
+    parser.add_argument('--bars', type=int, default=2000)
+    parser.add_argument('--companies', type=int, default=400)
+    parser.add_argument('--countries', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--optimize', action='store_true', help='create indexes and run ANALYZE afterwards')
+    parser.add_argument('--split-by', choices=SPLIT_KEYS,
+                        help='also write one shard per company region or review year')
+    args = parser.parse_args(argv)
+    generate(args.output, args.bars, args.companies, args.countries, args.seed)
+    shards = split(args.output, args.split_by) if args.split_by else []
+    if args.optimize:
+        for path in [args.output] + shards:
+            proj3_choc.ensure_indexes(path)
+    for shard in shards:
+        print(shard)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
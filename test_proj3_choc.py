@@ -0,0 +1,567 @@
+import csv
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import bench_choc
+import proj3_choc
+import synth_choc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SyntheticDatabaseTest(unittest.TestCase):
+    '''Base class for tests over a small synthetic database, which has NULL
+    ratings, cocoa percentages and countries and companies with two
+    locations. Every test gets its own copy of the database as DBNAME, with
+    the result cache turned off.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.directory, 'synth.sqlite')
+        synth_choc.generate(cls.source, bars=3000, companies=150, countries=40, seed=7)
+        proj3_choc.ensure_indexes(cls.source)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.dbname = proj3_choc.DBNAME
+        self.path = os.path.join(self.directory, self.id().rsplit('.', 1)[-1] + '.sqlite')
+        shutil.copyfile(self.source, self.path)
+        proj3_choc.close_pool()
+        proj3_choc.DBNAME = self.path
+        proj3_choc.configure_result_cache(0)
+
+    def tearDown(self):
+        proj3_choc.set_shards(None)
+        proj3_choc.set_backend('sqlite')
+        proj3_choc.close_pool()
+        proj3_choc.DBNAME = self.dbname
+        proj3_choc.configure_result_cache()
+
+    def commands(self, limit=10):
+        # Every suite command, with a short limit and with one past the number of bars.
+        commands = bench_choc.suite_commands(self.path, limit)
+        return commands + [command.replace(f' {limit}', ' 100000') for command in commands]
+
+
+class ShardTest(SyntheticDatabaseTest):
+    def test_data_has_nulls(self):
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            counts = connection.execute('select count(*)-count(Rating),count(*)-count(CocoaPercent),\
+count(*)-count(CompanyLocationId) from Bars').fetchone()
+        finally:
+            connection.close()
+        self.assertTrue(all(counts), counts)
+
+    def test_shards_match_single_database(self):
+        paths = synth_choc.split(self.path)
+        self.assertGreater(len(paths), 1)
+        for command in self.commands():
+            plan = proj3_choc.parse_command(command)
+            proj3_choc.set_shards(None)
+            expected = proj3_choc.fetch_plan(plan)
+            proj3_choc.set_shards(paths)
+            with self.subTest(command=command):
+                self.assertEqual(proj3_choc.fetch_plan(plan), expected)
+
+
+class PagerTest(SyntheticDatabaseTest):
+    def check_pages(self):
+        for command in bench_choc.suite_commands(self.path, 25):
+            plan = proj3_choc.parse_command(command)
+            expected = proj3_choc.fetch_plan(plan._replace(limit=100000))
+            pager = proj3_choc.Pager(plan)
+            pages = [list(pager.first())]
+            while True:
+                page = pager.next()
+                if page is None:
+                    break
+                pages.append(list(page))
+            backwards = []
+            while True:
+                page = pager.prev()
+                if page is None:
+                    break
+                backwards.append(list(page))
+            with self.subTest(command=command):
+                self.assertEqual([row for page in pages for row in page], expected)
+                self.assertEqual(backwards, pages[-2::-1])
+
+    def test_pages_join_up(self):
+        self.check_pages()
+
+    def test_pages_join_up_with_summaries(self):
+        proj3_choc.create_summaries(self.path)
+        self.check_pages()
+
+
+class SummaryTableTest(SyntheticDatabaseTest):
+    def summary_rows(self):
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            return {table: [tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+                            for row in connection.execute(f'select * from {table} order by 1,2')]
+                    for table in proj3_choc.SUMMARY_KEYS}
+        finally:
+            connection.close()
+
+    def test_summaries_follow_changes(self):
+        proj3_choc.create_summaries(self.path)
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            with connection:
+                connection.execute("insert into Bars (Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,\
+CompanyLocationId,Rating,BeanType,BroadBeanOriginId) values ('Maker 0','New','1','2020',0.7,1,4.0,'',2),\
+('New Maker','Newer','2','2020',null,null,null,'',null)")
+                connection.execute('update Bars set Rating=null where Id%50=1')
+                connection.execute('update Bars set CocoaPercent=0.5,Rating=2.5 where Id%70=2')
+                connection.execute('update Bars set CompanyLocationId=3,BroadBeanOriginId=null where Id%90=3')
+                connection.execute("update Bars set Company='Maker 1' where Id%110=4")
+                connection.execute('delete from Bars where Id%30=5')
+        finally:
+            connection.close()
+        maintained = self.summary_rows()
+        proj3_choc.create_summaries(self.path)
+        self.assertEqual(maintained, self.summary_rows())
+
+    def test_summary_tables_match_queries(self):
+        expected = [proj3_choc.fetch_plan(proj3_choc.parse_command(command)) for command in self.commands()]
+        proj3_choc.create_summaries(self.path)
+        for command, rows in zip(self.commands(), expected):
+            if not command.startswith('bars'):
+                with self.subTest(command=command):
+                    self.assertEqual(proj3_choc.fetch_plan(proj3_choc.parse_command(command)), rows)
+
+
+class SummaryTest(SyntheticDatabaseTest):
+    def test_summary_views_match_queries(self):
+        summary = proj3_choc.fetch_summary()
+        try:
+            for command in self.commands():
+                if command.startswith('bars'):
+                    continue
+                with self.subTest(command=command):
+                    self.assertEqual(summary.view(command), proj3_choc.fetch_plan(proj3_choc.parse_command(command)))
+        finally:
+            summary.close()
+
+
+@unittest.skipIf(numpy is None, 'the columnar backend needs numpy')
+class ColumnarTest(SyntheticDatabaseTest):
+    def test_columnar_matches_sqlite(self):
+        for command in self.commands():
+            plan = proj3_choc.parse_command(command)
+            proj3_choc.set_backend('sqlite')
+            expected = proj3_choc.fetch_plan(plan)
+            proj3_choc.set_backend('columnar')
+            with self.subTest(command=command):
+                self.assertEqual(proj3_choc.fetch_plan(plan), expected)
+
+
+class ShardSearchTest(SyntheticDatabaseTest):
+    def test_search_needs_the_index_on_every_shard(self):
+        paths = synth_choc.split(self.path)
+        plan = proj3_choc.parse_command('search maker ratings top 20')
+        proj3_choc.set_shards(paths)
+        self.assertRaises(proj3_choc.SearchUnavailable, proj3_choc.fetch_plan, plan)
+        proj3_choc.create_search_index(paths[0])
+        self.assertRaises(proj3_choc.SearchUnavailable, proj3_choc.fetch_plan, plan)
+
+    def test_build_search_on_shards(self):
+        paths = synth_choc.split(self.path)
+        arguments = [argument for path in paths for argument in ('--shard', path)]
+        self.assertEqual(proj3_choc.main(['--build-search'] + arguments), 0)
+        rows = proj3_choc.fetch_plan(proj3_choc.parse_command('search maker ratings top 20'))
+        proj3_choc.set_shards(None)
+        proj3_choc.create_search_index(self.path)
+        self.assertEqual(rows, proj3_choc.fetch_plan(proj3_choc.parse_command('search maker ratings top 20')))
+        self.assertEqual(len(rows), 20)
+
+
+class SearchSyntaxTest(unittest.TestCase):
+    def terms(self, command):
+        return proj3_choc.parse_command(command).terms
+
+    def test_words_become_phrases(self):
+        self.assertEqual(self.terms('search maker'), '"maker"')
+        self.assertEqual(self.terms('search dark milk'), '"dark" "milk"')
+        self.assertEqual(self.terms('search dark*'), '"dark"*')
+
+    def test_columns_and_quoted_phrases(self):
+        self.assertEqual(self.terms('search company:"maker 1"'), 'Company:"maker 1"')
+        self.assertEqual(self.terms('search origin:"costa rica"'), 'Origin:"costa rica"')
+        self.assertEqual(self.terms('search name:bar*'), 'Name:"bar"*')
+        self.assertEqual(self.terms('search other:word'), '"other:word"')
+
+    def test_options_are_not_terms(self):
+        plan = proj3_choc.parse_command('search maker ratings bottom 5 region=Europe')
+        self.assertEqual((plan.terms, plan.metric, plan.order, plan.limit), ('"maker"', 'ratings', 'bottom', 5))
+        self.assertEqual((plan.area, plan.area_value), ('region', 'Europe'))
+        self.assertEqual(self.terms('search "top"'), '"top"')
+
+    def test_quotes_are_escaped(self):
+        self.assertEqual(self.terms('search a"b'), '"a""b"')
+
+    def test_nothing_to_search_for(self):
+        for command in ('search', 'search 5', 'search top', 'search ""', 'search company:'):
+            with self.subTest(command=command):
+                self.assertRaises(proj3_choc.CommandError, proj3_choc.parse_command, command)
+
+
+class SearchIndexTest(SyntheticDatabaseTest):
+    def index_rows(self):
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            return connection.execute('select rowid,Name,Company,Origin from BarsSearch order by rowid').fetchall()
+        finally:
+            connection.close()
+
+    def test_search_needs_the_index(self):
+        self.assertRaises(proj3_choc.SearchUnavailable, proj3_choc.fetch_plan,
+                          proj3_choc.parse_command('search maker'))
+
+    def test_triggers_keep_the_index_in_step(self):
+        proj3_choc.create_search_index(self.path)
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            with connection:
+                connection.execute("insert into Bars (Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,\
+CompanyLocationId,Rating,BeanType,BroadBeanOriginId) values ('Nouveau','Grand Cru','1','2020',0.7,1,4.0,'',2)")
+                connection.execute("update Bars set SpecificBeanBarName='Renamed' where Id%40=1")
+                connection.execute('update Bars set BroadBeanOriginId=5 where Id%60=2')
+                connection.execute("update Countries set EnglishName='Renamed Land' where Id=5")
+                connection.execute('delete from Bars where Id%30=3')
+        finally:
+            connection.close()
+        maintained = self.index_rows()
+        proj3_choc.create_search_index(self.path)
+        self.assertEqual(maintained, self.index_rows())
+        rows = proj3_choc.fetch_plan(proj3_choc.parse_command('search origin:"renamed land" top 1000'))
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            count = connection.execute('select count(*) from Bars where BroadBeanOriginId=5').fetchone()[0]
+        finally:
+            connection.close()
+        self.assertEqual(len(rows), count)
+        self.assertEqual(len(proj3_choc.fetch_plan(proj3_choc.parse_command('search nouveau'))), 1)
+
+
+class ParserTest(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(proj3_choc.parse_command(''), proj3_choc.QueryPlan())
+        self.assertEqual(proj3_choc.parse_command('bars'), proj3_choc.QueryPlan())
+
+    def test_options(self):
+        plan = proj3_choc.parse_command('regions source cocoa bottom 3 barplot')
+        self.assertEqual(plan, proj3_choc.QueryPlan('regions', 'cocoa', 'source', order='bottom', limit=3, barplot=True))
+        plan = proj3_choc.parse_command('BARS Country=us cocoa')
+        self.assertEqual((plan.family, plan.metric, plan.area, plan.area_value), ('bars', 'cocoa', 'country', 'US'))
+        plan = proj3_choc.parse_command('countries region=europe number_of_bars')
+        self.assertEqual((plan.area, plan.area_value, plan.metric), ('region', 'Europe', 'number_of_bars'))
+
+    def test_first_option_of_a_kind_wins(self):
+        plan = proj3_choc.parse_command('companies cocoa ratings bottom top 5 7')
+        self.assertEqual((plan.metric, plan.order, plan.limit), ('cocoa', 'bottom', 5))
+
+    def test_regions_is_not_a_region_filter(self):
+        for command in ('regions', 'regions sell', 'regions ratings top 3'):
+            with self.subTest(command=command):
+                plan = proj3_choc.parse_command(command)
+                self.assertEqual((plan.family, plan.area, plan.area_value), ('regions', 'none', None))
+
+    def test_equal_commands_give_equal_plans(self):
+        plans = {proj3_choc.parse_command(command) for command in
+                 ('companies ratings top 10', 'companies top ratings', 'Companies 10 RATINGS', 'companies')}
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(proj3_choc.parse_command('bars barplot').key, proj3_choc.parse_command('bars'))
+
+    def test_family_argument(self):
+        self.assertEqual(proj3_choc.parse_command('cocoa bottom', family='bars'),
+                         proj3_choc.parse_command('bars cocoa bottom'))
+
+    def test_rejected_commands(self):
+        for command in ('unknown', 'ratings', 'countries country=us', 'regions region=asia', 'bars country=usa',
+                        'bars country=u1', 'bars region=', 'bars region=Asia country=US', 'companies source',
+                        'companies sell country', 'bars 3.5', 'bars -1', 'bars number_of_bars', 'bars rank'):
+            with self.subTest(command=command):
+                self.assertRaises(proj3_choc.CommandError, proj3_choc.parse_command, command)
+
+
+class BoundParameterTest(SyntheticDatabaseTest):
+    def test_values_are_bound(self):
+        us = proj3_choc.parse_command('bars country=US 7')
+        fr = proj3_choc.parse_command('bars country=FR 9')
+        sql, parameters = proj3_choc.plan_query(us)
+        self.assertIs(sql, proj3_choc.plan_query(fr)[0])
+        self.assertNotIn('US', sql)
+        self.assertEqual(parameters, ('US', 7))
+
+    def test_quotes_in_an_area_value(self):
+        for value in ("U'S", "US' or '1'='1", 'US"; drop table Bars; --'):
+            plan = proj3_choc.QueryPlan('companies', area='country', area_value=value, limit=100000)
+            with self.subTest(value=value):
+                self.assertNotIn(value, proj3_choc.plan_query(plan)[0])
+                self.assertEqual(proj3_choc.fetch_plan(plan), [])
+        self.assertTrue(proj3_choc.fetch_plan(proj3_choc.parse_command('bars')))
+
+    def test_quotes_in_a_search_term(self):
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            with connection:
+                connection.execute("insert into Bars (Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,\
+CompanyLocationId,Rating,BeanType,BroadBeanOriginId) values ('O''Brien','Say \"when\"','1','2020',0.7,1,4.0,'',2)")
+        finally:
+            connection.close()
+        proj3_choc.create_search_index(self.path)
+        for command in ("search o'brien", 'search "say when"', "search company:\"o'brien\" name:when"):
+            with self.subTest(command=command):
+                plan = proj3_choc.parse_command(command)
+                self.assertNotIn("o'brien", proj3_choc.plan_query(plan)[0].lower())
+                self.assertEqual([row[:2] for row in proj3_choc.fetch_plan(plan)], [('Say "when"', "O'Brien")])
+
+
+class ResultCacheTest(SyntheticDatabaseTest):
+    def write(self, sql, parameters=()):
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            with connection:
+                connection.execute(sql, parameters)
+        finally:
+            connection.close()
+
+    def test_lru_and_counters(self):
+        cache = proj3_choc.ResultCache(maxsize=2)
+        cache.put('a', [(1,)])
+        cache.put('b', [(2,)])
+        self.assertEqual(cache.get('a'), [(1,)])
+        cache.put('c', [(3,)])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), [(3,)])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['entries']), (2, 1, 1, 2))
+
+    def test_ttl_and_memory_budget(self):
+        cache = proj3_choc.ResultCache(ttl=-1)
+        cache.put('a', [(1,)])
+        self.assertIsNone(cache.get('a'))
+        cache = proj3_choc.ResultCache(max_bytes=1)
+        cache.put('a', [('too large',)])
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidated_by_a_write(self):
+        proj3_choc.configure_result_cache()
+        plan = proj3_choc.parse_command('companies ratings top 5')
+        before = proj3_choc.fetch_plan(plan)
+        self.assertEqual(proj3_choc.fetch_plan(plan), before)
+        self.assertGreater(proj3_choc.cache_stats()['hits'], 0)
+        self.write('update Bars set Rating=5 where Company=?', (before[-1][0],))
+        after = proj3_choc.fetch_plan(plan)
+        self.assertNotEqual(after, before)
+        self.assertEqual(after[0][0], before[-1][0])
+        self.assertEqual(proj3_choc.cache_stats()['invalidations'], 1)
+
+    def test_rows_read_before_a_write_are_not_stored(self):
+        cache = proj3_choc.ResultCache(watcher=proj3_choc.DatabaseWatcher(self.path))
+        try:
+            rows, stamp = cache.lookup('bars')
+            self.assertIsNone(rows)
+            self.write('delete from Bars where Id=1')
+            cache.put('bars', [('stale',)], stamp)
+            self.assertIsNone(cache.get('bars'))
+            rows, stamp = cache.lookup('bars')
+            cache.put('bars', [('fresh',)], stamp)
+            self.assertEqual(cache.get('bars'), [('fresh',)])
+        finally:
+            cache.watcher.close()
+
+
+class TableFormatTest(unittest.TestCase):
+    '''Expected outputs are those of pandas' DataFrame.to_string(index=False,
+    header=False, max_colwidth=16), which write_table replaces.
+    '''
+    def table(self, rows, lookahead=proj3_choc.TABLE_LOOKAHEAD):
+        out = io.StringIO()
+        proj3_choc.write_table(rows, out, lookahead)
+        return out.getvalue()
+
+    def test_text_and_numbers(self):
+        rows = [('Bonnat', 'France', 3.75, 0.7, 12), ('A', 'US', 2.5, 0.75, 5)]
+        self.assertEqual(self.table(rows), 'Bonnat France 3.75 0.70 12\n     A     US 2.50 0.75  5\n')
+        self.assertEqual(self.table([(1,), (100,), (-5,)]), '  1\n100\n -5\n')
+
+    def test_float_precision(self):
+        self.assertEqual(self.table([(1.5,), (2.25,), (3.125,)]), '1.500\n2.250\n3.125\n')
+        self.assertEqual(self.table([(3.14159265,), (2.0,)]), '3.141593\n2.000000\n')
+        self.assertEqual(self.table([(-1.5,), (0.0,)]), '-1.5\n 0.0\n')
+        self.assertEqual(self.table([(12345678.5,), (1.25,)]), '12345678.50\n       1.25\n')
+
+    def test_scientific_notation(self):
+        self.assertEqual(self.table([(1e-7,), (2.5,)]), '1.000000e-07\n2.500000e+00\n')
+        self.assertEqual(self.table([(123456789012345.5,), (1.0,)]), '1.234568e+14\n1.000000e+00\n')
+
+    def test_truncation(self):
+        rows = [('A very long chocolate bar name', 1), ('short', 22)]
+        self.assertEqual(self.table(rows), 'A very long c...  1\n           short 22\n')
+
+    def test_none(self):
+        self.assertEqual(self.table([(None, 3.5, 4), (1.25, None, None)]), ' NaN 3.5 4.0\n1.25 NaN NaN\n')
+        self.assertEqual(self.table([('x', None, 1), ('y', None, 2)]), 'x None 1\ny None 2\n')
+        self.assertEqual(proj3_choc.format_percent(('Peru', 0.705, None), 1), ('Peru', '70%', None))
+        self.assertEqual(proj3_choc.format_percent(('Peru', None), 1), ('Peru', None))
+
+    def test_empty_result(self):
+        self.assertEqual(self.table([]), proj3_choc.EMPTY_TABLE + '\n')
+        self.assertEqual(proj3_choc.EMPTY_TABLE, 'Empty DataFrame\nColumns: []\nIndex: []')
+
+    def test_spooled_rows(self):
+        rows = [(f'Maker {number}', number / 7, None if number % 3 else number) for number in range(50)]
+        self.assertEqual(self.table(iter(rows), lookahead=4), self.table(rows))
+
+
+class LoadCsvTest(unittest.TestCase):
+    HEADER = 'Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,CompanyLocation,Rating,BeanType,BroadBeanOrigin\n'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'choc.sqlite')
+        self.countries = self.write('countries.csv', 'Alpha2,Alpha3,EnglishName,Region,Subregion,Population,Area\n\
+FR,FRA,France,Europe,Western Europe,67000000,551695\nPE,PER,Peru,Americas,South America,33000000,1285216\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', newline='') as f:
+            f.write(text)
+        return path
+
+    def bars(self):
+        connection = proj3_choc.connect_writable(self.path)
+        try:
+            return connection.execute('select Company,SpecificBeanBarName,REF,ReviewDate from Bars order by Id').fetchall()
+        finally:
+            connection.close()
+
+    def test_append_skips_reviews_already_loaded(self):
+        first = self.write('first.csv', self.HEADER + 'Bonnat,Peru,1000,2012,70%,France,3.5,,Peru\n\
+Bonnat,Chuao,1000,2012,75%,France,4,,Peru\nA. Morin,Pura,n/a,2014,70%,France,3,,Peru\n')
+        stats = proj3_choc.load_csv(first, self.countries, self.path)
+        self.assertEqual((stats['bars'], stats['countries'], stats['skipped']), (3, 2, 0))
+        second = self.write('second.csv', self.HEADER + 'Bonnat,Chuao,1000,2012,75%,France,4,,Peru\n\
+Bonnat,Cuba,1000,2012,72%,France,3.25,,Peru\nA. Morin,Pura,n/a,2014,70%,France,3,,Peru\n\
+Pralus,Tanzanie,900,2016,75%,France,3.5,,Peru\nPralus,Tanzanie,900,2016,75%,France,3.5,,Peru\n')
+        stats = proj3_choc.load_csv(second, dbname=self.path, append=True)
+        self.assertEqual((stats['bars'], stats['skipped']), (2, 3))
+        self.assertEqual(self.bars()[3:], [('Bonnat', 'Cuba', '1000', '2012'), ('Pralus', 'Tanzanie', '900', '2016')])
+        stats = proj3_choc.load_csv(second, dbname=self.path, append=True)
+        self.assertEqual((stats['bars'], stats['skipped']), (0, 5))
+        self.assertEqual(len(self.bars()), 5)
+
+
+class BatchTest(SyntheticDatabaseTest):
+    LINES = ['bars 3', 'nonsense', 'companies cocoa 2', '# a comment', '', 'countries region=europe 2']
+
+    def tearDown(self):
+        proj3_choc.set_output()
+        super().tearDown()
+
+    def run_batch(self, fmt, **options):
+        proj3_choc.set_output(fmt, options.pop('directory', None))
+        out, err = io.StringIO(), io.StringIO()
+        count = proj3_choc.run_batch(self.LINES, out, err, workers=2, **options)
+        self.assertEqual(count, 4)
+        return out.getvalue(), err.getvalue()
+
+    def test_tables_keep_errors_in_place(self):
+        out = io.StringIO()
+        self.assertEqual(proj3_choc.run_batch(self.LINES, out, workers=2), 4)
+        out = out.getvalue()
+        expected = [proj3_choc.print_query_result('bars 3'), proj3_choc.NOT_RECOGNIZED,
+                    proj3_choc.print_query_result('companies cocoa 2'),
+                    proj3_choc.print_query_result('countries region=europe 2')]
+        self.assertEqual(out, '\n'.join(expected) + '\n')
+
+    def test_ndjson_is_one_stream(self):
+        for processes in (False, True):
+            with self.subTest(processes=processes):
+                out, err = self.run_batch('ndjson', processes=processes)
+                records = [json.loads(line) for line in out.splitlines()]
+                self.assertEqual([record['Command'] for record in records],
+                                 ['bars 3'] * 3 + ['companies cocoa 2'] * 2 + ['countries region=europe 2'] * 2)
+                self.assertEqual(records[3], dict(zip(('Command', 'Company', 'CompanyLocation', 'AvgCocoaPercent'),
+                                                      ('companies cocoa 2',) + proj3_choc.fetch_plan(
+                                                          proj3_choc.parse_command('companies cocoa 2'))[0])))
+                self.assertEqual(err, proj3_choc.NOT_RECOGNIZED + '\n')
+
+    def test_csv_has_a_header_per_command(self):
+        out, err = self.run_batch('csv')
+        rows = list(csv.reader(io.StringIO(out)))
+        self.assertEqual([row[0] for row in rows], ['Command'] + ['bars 3'] * 3 + ['Command'] +
+                         ['companies cocoa 2'] * 2 + ['Command'] + ['countries region=europe 2'] * 2)
+        self.assertEqual(err, proj3_choc.NOT_RECOGNIZED + '\n')
+
+    def test_output_directory(self):
+        directory = os.path.join(self.directory, 'out')
+        out, err = self.run_batch('csv', directory=directory)
+        path = os.path.join(directory, 'companies-cocoa-sell-top-2.csv')
+        self.assertIn(f'2 rows written to {path}\n', out)
+        with open(path, newline='') as f:
+            self.assertEqual(next(csv.reader(f)), ['Company', 'CompanyLocation', 'AvgCocoaPercent'])
+        self.assertEqual(len(os.listdir(directory)), 3)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class DaemonSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'choc.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_refuses_a_live_socket(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as live:
+            live.bind(self.path)
+            live.listen()
+            with self.assertRaises(RuntimeError):
+                proj3_choc.serve(self.path)
+            self.assertTrue(os.path.exists(self.path))
+
+    def test_replaces_a_stale_socket(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(self.path)
+        here = os.path.dirname(os.path.abspath(__file__))
+        daemon = subprocess.Popen([sys.executable, os.path.join(here, 'proj3_choc.py'), '--daemon', '--socket', self.path],
+                                  cwd=here)
+        try:
+            for _ in range(100):
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    if client.connect_ex(self.path) == 0:
+                        break
+                time.sleep(0.05)
+            else:
+                self.fail('the daemon did not start listening')
+        finally:
+            daemon.terminate()
+            self.assertEqual(daemon.wait(10), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()